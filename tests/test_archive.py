@@ -0,0 +1,78 @@
+"""
+Tests for `zcant.archive`.
+
+---------------
+Myotisoft ZCANT
+Copyright (C) 2012-2017 Myotisoft LLC, all rights reserved.
+You may use, distribute, and modify this code under the terms of the MIT License.
+"""
+
+import os
+import os.path
+import sys
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+
+import numpy as np
+
+from zcant.anabat import AnabatFileWriter, extract_anabat_dots
+from zcant.archive import NightArchive, pack_anabat, unpack_anabat
+
+
+PY2_ONLY = unittest.skipIf(sys.version_info[0] > 2, 'the Anabat file writer is Python 2 only')
+
+
+class PackUnpackTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.indir = os.path.join(self.tmpdir, 'in')
+        self.outdir = os.path.join(self.tmpdir, 'out')
+        os.makedirs(self.indir)
+        os.makedirs(self.outdir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def write_anabat(self, fname, species, **header):
+        intervals_us = 30 + np.arange(200, dtype=np.int64) % 7
+        with AnabatFileWriter(os.path.join(self.indir, fname)) as out:
+            out.write_header(datetime(2017, 5, 1, 21, 30, 0), 16, species=species, **header)
+            out.write_intervals(intervals_us)
+
+    @PY2_ONLY
+    def test_roundtrip_with_species(self):
+        self.write_anabat('P5012130.00#', 'Mylu, Epfu', tape='T1', loc='Site A', spec='Mylu?', note1='n1', note2='n2', id_code='ABC')
+        archive = os.path.join(self.tmpdir, 'night.zca')
+        self.assertEqual(pack_anabat(archive, [os.path.join(self.indir, 'P5012130.00#')]), 1)
+        self.assertEqual(unpack_anabat(archive, self.outdir), 1)
+
+        times, freqs, amplitudes, status, metadata = extract_anabat_dots(os.path.join(self.outdir, 'P5012130.00#'), hpfilter_khz=0)
+        original = extract_anabat_dots(os.path.join(self.indir, 'P5012130.00#'), hpfilter_khz=0)
+        self.assertEqual(metadata['species'], ['Mylu', 'Epfu'])
+        for k in ('tape', 'loc', 'spec', 'note1', 'note2', 'id', 'timestamp', 'divratio'):
+            self.assertEqual(metadata[k], original[4][k], k)
+        self.assertEqual(len(times), len(original[0]))
+        np.testing.assert_allclose(times, original[0])
+
+
+    @PY2_ONLY
+    def test_pack_latin1_header_and_skip_bad_file(self):
+        self.write_anabat('P5012130.00#', 'Mylu', loc='Montr\xe9al')
+        with open(os.path.join(self.indir, 'P5012131.00#'), 'wb') as f:
+            f.write('not an Anabat file')
+        self.write_anabat('P5012132.00#', 'Epfu')
+        archive = os.path.join(self.tmpdir, 'night.zca')
+        paths = [os.path.join(self.indir, fname) for fname in ('P5012130.00#', 'P5012131.00#', 'P5012132.00#')]
+        self.assertEqual(pack_anabat(archive, paths), 2)
+        with NightArchive(archive) as packed:
+            self.assertEqual(packed.names, ['P5012130.00#', 'P5012132.00#'])
+            self.assertEqual(packed[0].metadata['loc'], u'Montr\xe9al')
+        unpack_anabat(archive, self.outdir)
+        self.assertEqual(extract_anabat_dots(os.path.join(self.outdir, 'P5012130.00#'))[4]['loc'], 'Montr\xe9al')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+"""
+Tests for `zcant.core`.
+
+---------------
+Myotisoft ZCANT
+Copyright (C) 2012-2017 Myotisoft LLC, all rights reserved.
+You may use, distribute, and modify this code under the terms of the MIT License.
+"""
+
+import os
+import os.path
+import sys
+import wave
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from zcant import core
+from zcant.core import load_zerocross, save_anabat, converted_path
+
+
+PY2_ONLY = unittest.skipIf(sys.version_info[0] > 2, 'the .WAV reader and Anabat file writer are Python 2 only')
+
+
+def write_wav(fname, samplerate=384000, secs=0.5):
+    """Write a mono 16-bit .WAV of 40 kHz tone bursts over noise"""
+    t = np.arange(int(samplerate * secs)) / float(samplerate)
+    bursts = (t * 20) % 1.0 < 0.2
+    signal = 8000 * np.sin(2 * np.pi * 40000 * t) * bursts + np.random.RandomState(0).normal(0, 300, len(t))
+    wav = wave.open(fname, 'wb')
+    try:
+        wav.setparams((1, 2, samplerate, len(t), 'NONE', 'not compressed'))
+        wav.writeframes(signal.astype('<i2').tobytes())
+    finally:
+        wav.close()
+
+
+class ConvertedOutputReuseTest(unittest.TestCase):
+
+    KWARGS = dict(divratio=8, hpfilter_khz=17.5, threshold_factor=0.0, interpolation=False)
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.wav = os.path.join(self.tmpdir, 'site_20170501_213000.wav')
+        write_wav(self.wav)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def no_conversion(self, path, **kwargs):
+        self.fail('%s was converted again' % path)
+
+    @PY2_ONLY
+    def test_ungated_output_is_reused(self):
+        zc = load_zerocross(self.wav, **self.KWARGS)
+        save_anabat(zc, converted_path(self.wav), 8)
+
+        reloaded = load_zerocross(self.wav, extract=self.no_conversion, **self.KWARGS)
+        # Anabat can't assign the final two dots a frequency, so the high-pass filter drops them
+        self.assertEqual(len(reloaded), len(zc) - 2)
+        np.testing.assert_allclose(reloaded.times, zc.times[:-2], atol=1e-6)
+        self.assertEqual(reloaded.metadata['provenance']['Threshold'], '0.0')
+
+    @PY2_ONLY
+    def test_gated_output_is_reconverted(self):
+        zc = load_zerocross(self.wav, **self.KWARGS)
+        save_anabat(zc.gated(1.5), converted_path(self.wav), 8)
+
+        reloaded = load_zerocross(self.wav, **self.KWARGS)
+        self.assertNotIn('Gate', reloaded.metadata['provenance'])
+        self.assertEqual(len(reloaded), len(zc))
+        self.assertEqual(len(reloaded.gated(1.5)), len(zc.gated(1.5)))
+
+    @PY2_ONLY
+    def test_modified_source_is_reconverted(self):
+        zc = load_zerocross(self.wav, **self.KWARGS)
+        save_anabat(zc, converted_path(self.wav), 8)
+        st = os.stat(self.wav)
+        os.utime(self.wav, (st.st_atime, st.st_mtime + 60))  # as if edited in place, at the same size
+
+        converted = []
+        def extract(path, **kwargs):
+            converted.append(path)
+            return core.extract(path, **kwargs)
+
+        load_zerocross(self.wav, extract=extract, **self.KWARGS)
+        self.assertEqual(converted, [self.wav])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -45,16 +45,32 @@ def configure_logging(logfilename, level=logging.DEBUG):
         log.exception('Failed while configuring logging!')
 
 
+def start_workers():
+    """Start conversion worker processes; this must happen before the GUI toolkit is initialized"""
+    try:
+        from zcant.workers import ConversionPool
+        return ConversionPool()
+    except Exception:
+        logging.getLogger(__name__).exception('Failed starting conversion workers; converting in-process')
+        return None
+
+
 def zcant_gui():
     """Launch the ZCANT GUI"""
+    workers = start_workers()
+
     import wx
     from zcant.gui import ZcantMainFrame
 
-    app = wx.App(False)
-    frame = ZcantMainFrame(None)
-    frame.Maximize(True)
-    frame.Show(True)
-    app.MainLoop()
+    try:
+        app = wx.App(False)
+        frame = ZcantMainFrame(None, workers=workers)
+        frame.Maximize(True)
+        frame.Show(True)
+        app.MainLoop()
+    finally:
+        if workers:
+            workers.close()
 
 
 def main():
@@ -10,7 +10,9 @@ You may use, distribute, and modify this code under the terms of the MIT License
 from __future__ import division
 
 import io
+import os
 import mmap
+import zlib
 import struct
 import unicodedata
 import contextlib
@@ -19,7 +21,6 @@ from datetime import datetime
 from collections import OrderedDict
 
 import numpy as np
-from numpy.ma import masked_array
 
 from guano import GuanoFile, base64decode, base64encode
 
@@ -35,10 +36,75 @@ Byte = struct.Struct('< B')
 ANABAT_129_HEAD_FMT = '< H x B 2x 8s 8s 40s 50s 16s 73s 80s'  # 0x0: data_info_pointer, file_type, tape, date, loc, species, spec, note1, note2
 ANABAT_129_DATA_INFO_FMT = '< H H B B'  # 0x11a: data_pointer, res1, divratio, vres
 ANABAT_132_ADDL_DATA_INFO_FMT = '< H B B B B B B H 6s 32s'  # 0x120: year, month, day, hour, minute, second, second_hundredths, microseconds, id_code, gps_data
+ANABAT_HEADER_SIZE = 0x150  # v132 header size; any GUANO metadata block, then the data, follow
 
-GuanoFile.register('ZCANT', 'Amplitudes',
-                   lambda b64data: np.frombuffer(base64decode(b64data)),
-                   lambda data: base64encode(data.tobytes()))
+ANABAT_EST_BYTES_PER_DOT = 1.25  # rough; most intervals within a pulse are encoded as one-byte offsets
+
+# `ZCANT|Amplitudes` encodings; the legacy raw float64 encoding carries no version tag
+AMPLITUDES_FLOAT64  = 1  # base64 of raw float64 values
+AMPLITUDES_U16LOG   = 2  # base64 of uint16 log-quantized values, plus a scale factor
+AMPLITUDES_U16LOG_Z = 3  # as above, but delta-coded and zlib-compressed
+
+
+def encode_amplitudes(amplitudes, version=AMPLITUDES_U16LOG_Z):
+    """Serialize amplitude values for the `ZCANT|Amplitudes` GUANO field.
+
+    Compact encodings quantize log(1 + amplitude) to 16 bits, which preserves amplitude to within
+    about 0.01% while taking a fraction of the space of float64. They are serialized as
+    `<version> <scale> <base64 data>`.
+    """
+    amplitudes = np.asarray(amplitudes, dtype=np.float64)
+    if version == AMPLITUDES_FLOAT64:
+        return base64encode(amplitudes.tobytes())
+    elif version not in (AMPLITUDES_U16LOG, AMPLITUDES_U16LOG_Z):
+        raise ValueError('Unsupported amplitude encoding version %s' % version)
+    quantized, scale = quantize_amplitudes(amplitudes)
+    if version == AMPLITUDES_U16LOG_Z:
+        quantized[1:] -= quantized[:-1].copy()  # delta-code, wrapping modulo 2**16
+        data = zlib.compress(quantized.tobytes())
+    else:
+        data = quantized.tobytes()
+    return '%d %r %s' % (version, scale, base64encode(data))
+
+
+def decode_amplitudes(value):
+    """Deserialize amplitude values from any version of the `ZCANT|Amplitudes` GUANO field"""
+    parts = value.split()
+    if len(parts) == 1:
+        return np.frombuffer(base64decode(value))  # legacy, untagged float64
+    version, scale, data = int(parts[0]), float(parts[1]), base64decode(parts[2])
+    if version == AMPLITUDES_U16LOG:
+        quantized = np.frombuffer(data, dtype='<u2')
+    elif version == AMPLITUDES_U16LOG_Z:
+        quantized = np.cumsum(np.frombuffer(zlib.decompress(data), dtype='<u2'), dtype=np.uint16)
+    else:
+        raise ValueError('Unsupported amplitude encoding version %s' % version)
+    return dequantize_amplitudes(quantized, scale)
+
+
+def quantize_amplitudes(amplitudes):
+    """Quantize amplitude values to uint16 on a log scale. Produces (quantized, scale)."""
+    log_amplitudes = np.log1p(np.clip(np.asarray(amplitudes, dtype=np.float64), 0, None))
+    peak = np.amax(log_amplitudes) if len(log_amplitudes) else 0.0
+    scale = float(peak) / 0xFFFF if peak > 0 else 1.0
+    return np.rint(log_amplitudes / scale).astype('<u2'), scale
+
+
+def dequantize_amplitudes(quantized, scale):
+    """Inverse of `quantize_amplitudes()`"""
+    return np.expm1(quantized * scale)
+
+
+GuanoFile.register('ZCANT', 'Amplitudes', decode_amplitudes, encode_amplitudes)
+
+
+class AnabatFormatError(ValueError):
+    """Raised upon encountering corrupt or truncated Anabat data"""
+
+    def __init__(self, message, offset, dots):
+        ValueError.__init__(self, '%s at offset 0x%X (after %d dots)' % (message, offset, dots))
+        self.offset = offset  # file offset at which the bad data begins
+        self.dots = dots      # number of valid dots which precede it
 
 
 class DotStatus:
@@ -54,144 +120,356 @@ def _s(s):
     return s.strip('\00\t ')
 
 
+_guano_coercer = GuanoFile()  # used only for its registered value coercion rules
+
+
+class LazyGuano(object):
+    """Read-only GUANO metadata which is parsed lazily, field by field.
+
+    Up front we merely hold the raw metadata block. The first lookup indexes the offsets of each
+    `key: value` line, and an individual value is only decoded and coerced (eg. the base64 decoding
+    of our large `ZCANT|Amplitudes` array) when it is actually accessed.
+
+        guano = LazyGuano(raw_bytes)
+        if 'ZCANT|Amplitudes' in guano:
+            amplitudes = guano['ZCANT|Amplitudes']
+    """
+
+    def __init__(self, data, truncated=False):
+        """
+        :param data: raw GUANO metadata block
+        :param truncated: whether `data` is only a prefix of the full block, in which case its
+                          final (incomplete) line is ignored
+        """
+        self._data = data
+        self._truncated = truncated
+        self._offsets = None  # full key -> (start, end) offsets of its raw value
+        self._values = {}     # full key -> coerced value
+
+    def _index(self):
+        if self._offsets is not None:
+            return self._offsets
+        self._offsets = OrderedDict()
+        data, pos, size = self._data, 0, len(self._data)
+        while pos < size:
+            end = data.find('\n', pos)
+            if end < 0:
+                if self._truncated:
+                    break
+                end = size
+            colon = data.find(':', pos, end)
+            if colon > pos:
+                key = data[pos:colon].strip('\00\r\n\t ')
+                if key:
+                    self._offsets[key] = (colon + 1, end)
+            pos = end + 1
+        return self._offsets
+
+    def __contains__(self, key):
+        return key in self._index()
+
+    def __getitem__(self, key):
+        if key not in self._values:
+            start, end = self._index()[key]
+            value = self._data[start:end].strip('\00\r\n\t ')
+            try:
+                value = value.decode('utf-8')
+            except UnicodeDecodeError:
+                value = value.decode('latin-1')
+            self._values[key] = _guano_coercer._coerce(key, value)
+        return self._values[key]
+
+    def get(self, key, default=None):
+        """Get the value of a full `namespace|key`, decoding it only now"""
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return list(self._index().keys())
+
+    def discard(self, key):
+        """Forget a field entirely, both its raw line and any decoded value (eg. amplitudes which
+        have been handed off elsewhere, so that we don't hold them twice)"""
+        self._values.pop(key, None)
+        offsets = self._index()
+        if key not in offsets:
+            return
+        start, end = offsets[key]
+        start = self._data.rfind('\n', 0, start) + 1  # beginning of the line
+        self._data = self._data[:start] + self._data[end+1:]
+        self._offsets = None
+
+    @property
+    def nbytes(self):
+        """Approximate memory used by our raw block and decoded values"""
+        return len(self._data) + sum(getattr(v, 'nbytes', 0) for v in self._values.values())
+
+    def to_guano(self):
+        """Fully parse into a regular `GuanoFile`"""
+        return GuanoFile.from_string(self._data)
+
+    def __repr__(self):
+        return '%s(%d bytes)' % (self.__class__.__name__, len(self._data))
+
+
 @print_timing
-def hpf_zc(times_s, freqs_hz, amplitudes, cutoff_freq_hz):
+def hpf_zc(times_s, freqs_hz, amplitudes, status, cutoff_freq_hz):
     if not cutoff_freq_hz or len(freqs_hz) == 0:
-        return times_s, freqs_hz, amplitudes
-    hpf_mask = np.where(freqs_hz > cutoff_freq_hz)
+        return times_s, freqs_hz, amplitudes, status
+    hpf_mask = freqs_hz > cutoff_freq_hz
     junk_count = len(freqs_hz) - np.count_nonzero(hpf_mask)
     log.debug('HPF throwing out %d dots of %d (%.1f%%)', junk_count, len(freqs_hz), float(junk_count)/len(freqs_hz)*100)
-    return times_s[hpf_mask], freqs_hz[hpf_mask], amplitudes[hpf_mask] if amplitudes is not None else None
+    return times_s[hpf_mask], freqs_hz[hpf_mask], amplitudes[hpf_mask] if amplitudes is not None else None, status[hpf_mask]
+
+
+def _parse_header(buf):
+    """Parse the fixed-size header and data information table from a buffer (an mmap, or simply the
+    first 0x150 bytes of the file). Produces (file_type, data_pointer, res1, metadata)."""
+    data_info_pointer, file_type, tape, date, loc, species, spec, note1, note2 = struct.unpack_from(ANABAT_129_HEAD_FMT, buf)
+    data_pointer, res1, divratio, vres = struct.unpack_from(ANABAT_129_DATA_INFO_FMT, buf, data_info_pointer)
+    species = [_s(species).split('(', 1)[0]] if '(' in species else [s.strip() for s in _s(species).split(',')]  # remove KPro junk
+    metadata = dict(date=date, tape=_s(tape), loc=_s(loc), species=species, spec=_s(spec), note1=_s(note1), note2=_s(note2), divratio=divratio)
+    if file_type >= 132:
+        year, month, day, hour, minute, second, second_hundredths, microseconds, id_code, gps_data = struct.unpack_from(ANABAT_132_ADDL_DATA_INFO_FMT, buf, 0x120)
+        try:
+            timestamp = datetime(year, month, day, hour, minute, second, second_hundredths * 10000 + microseconds)
+        except ValueError as e:
+            log.exception('Failed extracting timestamp')
+            timestamp = None
+        metadata.update(dict(timestamp=timestamp, id=_s(id_code), gps=_s(gps_data)))
+    log.debug('file_type: %d\tdata_info_pointer: 0x%3x\tdata_pointer: 0x%3x', file_type, data_info_pointer, data_pointer)
+    return file_type, data_pointer, res1, metadata
+
+
+def _has_guano(file_type, data_pointer):
+    """Is there room for a GUANO metadata block between the v132 header and the data?"""
+    return file_type >= 132 and data_pointer - ANABAT_HEADER_SIZE > 12
 
 
 @print_timing
-def extract_anabat(fname, hpfilter_khz=8.0, **kwargs):
-    """Extract (times, frequencies, amplitudes, metadata) from Anabat sequence file"""
-    amplitudes = None
-    with open(fname, 'rb') as f, contextlib.closing(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)) as m:
-        size = len(m)
+def extract_anabat_header(fname, max_guano_bytes=4096):
+    """Extract only the metadata from an Anabat sequence file, without decoding any dots.
+
+    Just the fixed header and the first `max_guano_bytes` of any GUANO block are read, which makes
+    this suitable for cataloguing whole archives. GUANO fields which don't fit within that prefix
+    are skipped (so our bulky `ZCANT|Amplitudes` generally are too). The number of dots (`est_dots`) is only an
+    estimate derived from the size of the data section.
+    """
+    with open(fname, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        file_type, data_pointer, res1, metadata = _parse_header(f.read(ANABAT_HEADER_SIZE))
+        if _has_guano(file_type, data_pointer):
+            guano_len = data_pointer - ANABAT_HEADER_SIZE
+            data = f.read(min(guano_len, max_guano_bytes))
+            metadata['guano'] = LazyGuano(data, truncated=len(data) < guano_len)
+    metadata['res1'] = res1
+    metadata['est_dots'] = int(round(max(size - data_pointer, 0) / ANABAT_EST_BYTES_PER_DOT))
+    return metadata
+
+
+@print_timing
+def extract_anabat(fname, hpfilter_khz=8.0, amplitudes=True, **kwargs):
+    """Extract (times, frequencies, amplitudes, metadata) from Anabat sequence file.
+
+    Any GUANO metadata is available, lazily parsed, as `metadata['guano']` (less `ZCANT|Amplitudes`,
+    which are returned separately). Pass `amplitudes=False` to skip decoding the amplitude values
+    altogether (amplitudes are then `None`).
+    Off-dots are discarded; see `extract_anabat_dots()` to retain them.
+    """
+    times_s, freqs_hz, amplitudes, status, metadata = extract_anabat_dots(fname, hpfilter_khz, amplitudes)
+    off_mask = status == DotStatus.OFF
+    n_offdots = np.count_nonzero(off_mask)
+    if n_offdots:
+        log.debug('Throwing out %d off-dots of %d (%.1f%%)', n_offdots, len(times_s), float(n_offdots)/len(times_s)*100)
+        times_s, freqs_hz = times_s[~off_mask], freqs_hz[~off_mask]
+        amplitudes = amplitudes[~off_mask] if amplitudes is not None else None
+    return times_s, freqs_hz, amplitudes, metadata
+
 
+@print_timing
+def extract_anabat_dots(fname, hpfilter_khz=8.0, amplitudes=True, **kwargs):
+    """Extract (times, frequencies, amplitudes, status, metadata) from Anabat sequence file.
+
+    Unlike `extract_anabat()`, no off-dots are discarded; each dot's `DotStatus` is instead
+    produced as a uint8 array.
+    """
+    with open(fname, 'rb') as f, contextlib.closing(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)) as m:
         # parse header
-        data_info_pointer, file_type, tape, date, loc, species, spec, note1, note2 = struct.unpack_from(ANABAT_129_HEAD_FMT, m)
-        data_pointer, res1, divratio, vres = struct.unpack_from(ANABAT_129_DATA_INFO_FMT, m, data_info_pointer)
-        species = [_s(species).split('(', 1)[0]] if '(' in species else [s.strip() for s in _s(species).split(',')]  # remove KPro junk
-        metadata = dict(date=date, loc=_s(loc), species=species, spec=_s(spec), note1=_s(note1), note2=_s(note2), divratio=divratio)
-        if file_type >= 132:
-            year, month, day, hour, minute, second, second_hundredths, microseconds, id_code, gps_data = struct.unpack_from(ANABAT_132_ADDL_DATA_INFO_FMT, m, 0x120)
+        file_type, data_pointer, res1, metadata = _parse_header(m)
+        guano = None
+        if _has_guano(file_type, data_pointer):  # and m[pos:pos+5] == 'GUANO':
+            guano = metadata['guano'] = LazyGuano(m[ANABAT_HEADER_SIZE:data_pointer])
+        elif file_type >= 132:
+            log.debug('No GUANO metadata found')
+        if amplitudes and guano is not None:
             try:
-                timestamp = datetime(year, month, day, hour, minute, second, second_hundredths * 10000 + microseconds)
-            except ValueError as e:
-                log.exception('Failed extracting timestamp')
-                timestamp = None
-            metadata.update(dict(timestamp=timestamp, id=_s(id_code), gps=_s(gps_data)))
-            if data_pointer - 0x150 > 12:  # and m[pos:pos+5] == 'GUANO':
-                try:
-                    guano = GuanoFile.from_string(m[0x150:data_pointer])
-                    log.debug(guano.to_string())
-                    amplitudes = guano.get('ZCANT|Amplitudes', None)
-                except:
-                    log.exception('Failed parsing GUANO metadata block')
-            else:
-                log.debug('No GUANO metadata found')
-        log.debug('file_type: %d\tdata_info_pointer: 0x%3x\tdata_pointer: 0x%3x', file_type, data_info_pointer, data_pointer)
+                amplitudes = guano.get('ZCANT|Amplitudes', None)
+            except:
+                log.exception('Failed parsing GUANO amplitudes')
+                amplitudes = None
+        else:
+            amplitudes = None
+        if guano is not None:
+            guano.discard('ZCANT|Amplitudes')  # bulky, and returned separately
         log.debug(metadata)
         if res1 != 25000:
             raise ValueError('Anabat files with non-standard RES1 (%s) not yet supported!' % res1)
 
         # parse actual sequence data
-        i = data_pointer   # byte index as we scan through the file (data starts at 0x150 for v132, 0x120 for older files)
-        intervals_us = np.empty(2**14, np.dtype('uint32'))
-        offdots = OrderedDict()  # dot index -> number of subsequent dots
-        int_i = 0  # interval index
-
-        while i < size:
-            
-            if int_i >= len(intervals_us):
-                # Anabat files were formerly capped at 16384 dots, but may now be larger; grow
-                intervals_us = np.concatenate((intervals_us, np.empty(2**14, np.dtype('uint32'))))
-
-            byte = Byte.unpack_from(m, i)[0]
-
-            if byte <= 0x7F:
-                # Single byte is a 7-bit signed two's complement offset from previous interval
-                offset = byte if byte < 2**6 else byte - 2**7  # clever two's complement unroll
-                if int_i > 0:
-                    intervals_us[int_i] = intervals_us[int_i-1] + offset
-                    int_i += 1
-                else:
-                    log.warning('Sequence file starts with a one-byte interval diff! Skipping byte %x', byte)
-                    #intervals.append(offset)  # ?!
-
-            elif 0x80 <= byte <= 0x9F:
-                # time interval is contained in 13 bits, upper 5 from the remainder of this byte, lower 8 bits from the next byte
-                accumulator = (byte & 0b00011111) << 8
-                i += 1
-                accumulator |= Byte.unpack_from(m, i)[0]
-                intervals_us[int_i] = accumulator
-                int_i += 1
-
-            elif 0xA0 <= byte <= 0xBF:
-                # interval is contained in 21 bits, upper 5 from the remainder of this byte, next 8 from the next byte and the lower 8 from the byte after that
-                accumulator = (byte & 0b00011111) << 16
-                i += 1
-                accumulator |= Byte.unpack_from(m, i)[0] << 8
-                i += 1
-                accumulator |= Byte.unpack_from(m, i)[0]
-                intervals_us[int_i] = accumulator
-                int_i += 1
-
-            elif 0xC0 <= byte <= 0xDF:
-                # interval is contained in 29 bits, the upper 5 from the remainder of this byte, the next 8 from the following byte etc.
-                accumulator = (byte & 0b00011111) << 24
-                i += 1
-                accumulator |= Byte.unpack_from(m, i)[0] << 16
-                i += 1
-                accumulator |= Byte.unpack_from(m, i)[0] << 8
-                i += 1
-                accumulator |= Byte.unpack_from(m, i)[0]
-                intervals_us[int_i] = accumulator
-                int_i += 1
-
-            elif 0xE0 <= byte <= 0xFF:
-                # status byte which applies to the next n dots
-                status = byte & 0b00011111
-                i += 1
-                dotcount = Byte.unpack_from(m, i)[0]
-                if status == DotStatus.OFF:
-                    offdots[int_i] = dotcount
-                else:
-                    log.debug('UNSUPPORTED: Status %X for %d dots at dot %d (file offset 0x%X)', status, dotcount, int_i, i)
+        blocks = list(_decode_intervals(m, data_pointer, 2**14))
 
-            else:
-                raise Exception('Unknown byte %X at offset 0x%X' % (byte, i))
+    intervals_us = np.concatenate([b[0] for b in blocks]) if blocks else np.array([], np.dtype('uint32'))
+    status = np.concatenate([b[1] for b in blocks]) if blocks else np.array([], np.dtype('uint8'))
 
-            i += 1
+    times_s = np.cumsum(intervals_us, dtype=np.int64) * 1e-6
+    freqs_hz = _freqs(times_s, metadata['divratio'])
 
-    intervals_us = intervals_us[:int_i]  # TODO: should we free unused memory?
+    if amplitudes is not None and len(amplitudes) == len(times_s) + 1:
+        amplitudes = amplitudes[1:]  # written by an older ZCANT, which omitted the first dot's interval
+    elif amplitudes is not None and len(amplitudes) != len(times_s):
+        log.warning('Discarding %d amplitude values for %d dots', len(amplitudes), len(times_s))
+        amplitudes = None
 
-    intervals_s = intervals_us * 1e-6
-    times_s = np.cumsum(intervals_s)
-    freqs_hz = 1 / (times_s[2:] - times_s[:-2]) * divratio
+    min_, max_ = min(freqs_hz) if any(freqs_hz) else 0, max(freqs_hz) if any(freqs_hz) else 0
+    log.debug('%s\tDots: %d\tMinF: %.1f\tMaxF: %.1f', basename(fname), len(freqs_hz), min_/1000.0, max_/1000.0)
+
+    times_s, freqs_hz, amplitudes, status = hpf_zc(times_s, freqs_hz, amplitudes, status, hpfilter_khz*1000)
+
+    assert(len(times_s) == len(freqs_hz) == len(status) == len(amplitudes if amplitudes is not None else freqs_hz))
+    return times_s, freqs_hz, amplitudes, status, metadata
+
+
+def iter_anabat(fname, blocksize=4096):
+    """Generator which decodes an Anabat sequence file in fixed-size blocks of dots.
+
+    Produces (times, freqs, status) chunks of `blocksize` dots each (the final chunk may be
+    shorter), so that arbitrarily large sequence files may be processed in bounded memory, and
+    consumers may simply stop iterating once they have what they need. Unlike `extract_anabat()`,
+    no dots are discarded; off-dots and the like are identified by their `DotStatus`.
+    """
+    with open(fname, 'rb') as f, contextlib.closing(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)) as m:
+        file_type, data_pointer, res1, metadata = _parse_header(m)
+        if res1 != 25000:
+            raise ValueError('Anabat files with non-standard RES1 (%s) not yet supported!' % res1)
+        divratio = metadata['divratio']
+
+        # a dot's frequency depends upon the times of the following two dots, so we hold back
+        # the tail of each decoded block until we've seen the next
+        elapsed_us = 0
+        pending_times, pending_status = np.array([], np.float64), np.array([], np.dtype('uint8'))
+        for intervals_us, status in _decode_intervals(m, data_pointer, blocksize):
+            times_us = np.cumsum(intervals_us, dtype=np.int64) + elapsed_us
+            elapsed_us = times_us[-1]
+            pending_times = np.concatenate((pending_times, times_us * 1e-6))
+            pending_status = np.concatenate((pending_status, status))
+            while len(pending_times) >= blocksize + 2:
+                freqs_hz = _freqs(pending_times[:blocksize+2], divratio)[:blocksize]
+                yield pending_times[:blocksize], freqs_hz, pending_status[:blocksize]
+                pending_times, pending_status = pending_times[blocksize:], pending_status[blocksize:]
+        if len(pending_times):
+            yield pending_times, _freqs(pending_times, divratio), pending_status
+
+
+def _freqs(times_s, divratio):
+    """Calculate frequencies in Hz from dot times. The final two dots, which lack the two following
+    dots required to calculate frequency, are assigned 0Hz (as are out-of-range values)."""
+    freqs_hz = np.zeros(len(times_s))
+    if len(times_s) > 2:
+        with np.errstate(divide='ignore'):
+            freqs_hz[:-2] = 1 / (times_s[2:] - times_s[:-2]) * divratio
     freqs_hz[freqs_hz == np.inf] = 0  # TODO: fix divide-by-zero
     freqs_hz[freqs_hz < 4000] = 0
     freqs_hz[freqs_hz > 250000] = 0
+    return freqs_hz
+
+
+def _decode_intervals(m, i, blocksize):
+    """Generator which decodes Anabat interval data, starting at byte offset `i` of buffer `m`.
+    Produces (intervals_us, status) arrays of up to `blocksize` dots each.
+    Raises `AnabatFormatError` upon truncated data or an invalid (negative) interval."""
+    size = len(m)
+    intervals_us = np.empty(blocksize, np.dtype('uint32'))
+    status = np.empty(blocksize, np.dtype('uint8'))
+    dot_i = 0           # overall dot index
+    int_i = 0           # interval index within the current block
+    prev = None         # previous interval, which may belong to a previous block
+    dot_status, status_count = DotStatus.NORMAL, 0  # status applied to the next `status_count` dots
+
+    while i < size:
+        interval = None
+        byte = Byte.unpack_from(m, i)[0]
+        if byte > 0x7F and i + (1 if byte <= 0x9F or byte >= 0xE0 else 2 if byte <= 0xBF else 3) >= size:
+            raise AnabatFormatError('Truncated data', i, dot_i)
+
+        if byte <= 0x7F:
+            # Single byte is a 7-bit signed two's complement offset from previous interval
+            offset = byte if byte < 2**6 else byte - 2**7  # clever two's complement unroll
+            if prev is not None:
+                interval = prev + offset
+                if interval < 0:
+                    raise AnabatFormatError('Negative interval %d' % interval, i, dot_i)
+            else:
+                log.warning('Sequence file starts with a one-byte interval diff! Skipping byte %x', byte)
+                #intervals.append(offset)  # ?!
 
-    if offdots:
-        n_offdots = sum(offdots.values())
-        log.debug('Throwing out %d off-dots of %d (%.1f%%)', n_offdots, len(times_s), float(n_offdots)/len(times_s)*100)
-        off_mask = np.zeros(len(intervals_us), dtype=bool)
-        for int_i, dotcount in offdots.items():
-            off_mask[int_i:int_i+dotcount] = True
-        times_s = masked_array(times_s, mask=off_mask).compressed()
-        freqs_hz = masked_array(freqs_hz, mask=off_mask).compressed()
+        elif 0x80 <= byte <= 0x9F:
+            # time interval is contained in 13 bits, upper 5 from the remainder of this byte, lower 8 bits from the next byte
+            accumulator = (byte & 0b00011111) << 8
+            i += 1
+            accumulator |= Byte.unpack_from(m, i)[0]
+            interval = accumulator
 
-    min_, max_ = min(freqs_hz) if any(freqs_hz) else 0, max(freqs_hz) if any(freqs_hz) else 0
-    log.debug('%s\tDots: %d\tMinF: %.1f\tMaxF: %.1f', basename(fname), len(freqs_hz), min_/1000.0, max_/1000.0)
+        elif 0xA0 <= byte <= 0xBF:
+            # interval is contained in 21 bits, upper 5 from the remainder of this byte, next 8 from the next byte and the lower 8 from the byte after that
+            accumulator = (byte & 0b00011111) << 16
+            i += 1
+            accumulator |= Byte.unpack_from(m, i)[0] << 8
+            i += 1
+            accumulator |= Byte.unpack_from(m, i)[0]
+            interval = accumulator
 
-    times_s, freqs_hz, amplitudes = hpf_zc(times_s, freqs_hz, amplitudes, hpfilter_khz*1000)
+        elif 0xC0 <= byte <= 0xDF:
+            # interval is contained in 29 bits, the upper 5 from the remainder of this byte, the next 8 from the following byte etc.
+            accumulator = (byte & 0b00011111) << 24
+            i += 1
+            accumulator |= Byte.unpack_from(m, i)[0] << 16
+            i += 1
+            accumulator |= Byte.unpack_from(m, i)[0] << 8
+            i += 1
+            accumulator |= Byte.unpack_from(m, i)[0]
+            interval = accumulator
 
-    assert(len(times_s) == len(freqs_hz) == len(amplitudes or freqs_hz))
-    return times_s, freqs_hz, amplitudes, metadata
+        elif 0xE0 <= byte <= 0xFF:
+            # status byte which applies to the next n dots
+            dot_status = byte & 0b00011111
+            i += 1
+            status_count = Byte.unpack_from(m, i)[0]
+
+        else:
+            raise Exception('Unknown byte %X at offset 0x%X' % (byte, i))
+
+        if interval is not None:
+            intervals_us[int_i] = interval
+            if status_count:
+                status[int_i] = dot_status
+                status_count -= 1
+            else:
+                status[int_i] = DotStatus.NORMAL
+            prev = interval
+            dot_i += 1
+            int_i += 1
+            if int_i == blocksize:
+                yield intervals_us, status
+                intervals_us = np.empty(blocksize, np.dtype('uint32'))
+                status = np.empty(blocksize, np.dtype('uint8'))
+                int_i = 0
+
+        i += 1
+
+    if int_i:
+        yield intervals_us[:int_i], status[:int_i]
 
 
 def anabat_filename(timestamp):
@@ -212,6 +490,22 @@ def _pad(s, length, pad_chr=' '):
     return s[:length] + (length-len(s))*pad_chr
 
 
+def _status_runs(status):
+    """Produce {dot index: (status, dotcount)} marking the start of each run of dots whose status
+    isn't `DotStatus.NORMAL`. Runs longer than a single status byte can cover are split."""
+    status = np.asarray(status, dtype=np.uint8)
+    if not len(status):
+        return {}
+    edges = np.flatnonzero(np.diff(status)) + 1
+    runs = {}
+    for start, end in zip(np.concatenate(([0], edges)), np.concatenate((edges, [len(status)]))):
+        if status[start] == DotStatus.NORMAL:
+            continue
+        for i in range(start, end, 0xff):
+            runs[i] = (int(status[start]), int(min(0xff, end - i)))
+    return runs
+
+
 def _get_bytes(val, count):
     """Get a specified number of bytes from a numeric value.
     n = 0x345678
@@ -223,11 +517,11 @@ def _get_bytes(val, count):
 class AnabatFileWriter(object):
     """Interface for writing an Anabat file (v132).
 
-    Does NOT support GPS, altitude, point status (offdots, maindots), out-of-range points.
+    Does NOT support GPS, altitude.
 
     with AnabatWriter(outfname) as out:
         out.write_header(timestamp, 8, species='Mylu', note='line 1', note1='line 2')
-        out.write_intervals(sequence_of_intervals)
+        out.write_intervals(sequence_of_intervals, optional_sequence_of_dot_status)
     """
 
     def __init__(self, fname):
@@ -299,9 +593,17 @@ class AnabatFileWriter(object):
         self._f.write(guano)
         self.byte_count += len(guano)
 
-    def write_intervals(self, intervals):
-        """Write a sequence of transition intervals. You may call this multiple times."""
-        for interval in intervals:
+    def write_intervals(self, intervals, status=None):
+        """Write a sequence of transition intervals, optionally with the `DotStatus` of each.
+        You may call this multiple times."""
+        status_runs = _status_runs(status) if status is not None else {}
+        for i, interval in enumerate(intervals):
+            if i in status_runs:
+                # status byte which applies to the next n dots
+                dot_status, dotcount = status_runs[i]
+                self._f.write( struct.pack('< 2B', 0xe0 | dot_status, dotcount) )
+                self.byte_count += 2
+
             self.interval_count += 1
             self.length_us += interval
 
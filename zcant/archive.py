@@ -0,0 +1,334 @@
+"""
+Packed "night archive" container for many zero-cross sequences.
+
+Opening thousands of tiny Anabat files is dominated by per-file overhead, so a night archive packs
+many `ZeroCross` sequences into a single file which is read through `mmap`. Any single sequence,
+or all sequences within a time range, may be fetched without touching the rest.
+
+Layout (all values little-endian):
+
+    header      magic 'ZCANTNA1', version, count, index offset
+    sequences   for each sequence, 8-byte aligned:
+                    times as uint32 microsecond intervals (ie. delta-encoded)
+                    amplitudes as uint16 log-quantized values, delta-encoded (optional)
+                    status as uint8 `DotStatus` values (optional)
+                    UTF-8 JSON metadata
+    index       one `INDEX_DTYPE` record per sequence, sorted by timestamp
+
+Usage:
+    python -m zcant.archive pack NIGHT.zca DIR
+    python -m zcant.archive unpack NIGHT.zca OUTDIR
+    python -m zcant.archive list NIGHT.zca
+
+---------------
+Myotisoft ZCANT
+Copyright (C) 2012-2017 Myotisoft LLC, all rights reserved.
+You may use, distribute, and modify this code under the terms of the MIT License.
+"""
+
+from __future__ import print_function
+
+import io
+import os
+import os.path
+import json
+import mmap
+import struct
+import argparse
+import calendar
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from zcant import print_timing
+from guano import GuanoFile
+
+from zcant.anabat import AnabatFileWriter, extract_anabat_dots, quantize_amplitudes, dequantize_amplitudes, _freqs
+from zcant.core import ZeroCross
+from zcant.validate import find_anabat_files
+
+import logging
+log = logging.getLogger(__name__)
+
+
+__all__ = 'NightArchive', 'NightArchiveWriter', 'pack_anabat', 'unpack_anabat'
+
+
+MAGIC = 'ZCANTNA1'
+VERSION = 1
+HEADER_FMT = '< 8s H 2x I Q'  # magic, version, count, index_offset
+HEADER_SIZE = struct.calcsize(HEADER_FMT)
+
+INDEX_DTYPE = np.dtype([
+    ('timestamp_us', '<i8'),  # microseconds since the epoch, or NO_TIMESTAMP
+    ('offset',       '<u8'),  # file offset of the sequence's data
+    ('dots',         '<u4'),
+    ('flags',        '<u4'),
+    ('meta_length',  '<u4'),
+    ('name',         'S36'),
+])
+
+NO_TIMESTAMP = np.iinfo(np.int64).min
+
+FLAG_AMPLITUDES = 0x1
+FLAG_STATUS     = 0x2
+
+_EPOCH = datetime(1970, 1, 1)
+
+
+def _to_us(timestamp):
+    """Naive datetime to microseconds since the epoch"""
+    if timestamp is None:
+        return NO_TIMESTAMP
+    return calendar.timegm(timestamp.timetuple()) * 1000000 + timestamp.microsecond
+
+
+def _from_us(timestamp_us):
+    """Microseconds since the epoch to naive datetime"""
+    if timestamp_us == NO_TIMESTAMP:
+        return None
+    return _EPOCH + timedelta(microseconds=int(timestamp_us))
+
+
+def _align(n, alignment=8):
+    return (n + alignment - 1) // alignment * alignment
+
+
+def _decode_header_text(metadata):
+    """Decode the Anabat header's text fields, which are bytes in no declared encoding, as Latin-1"""
+    for k, v in metadata.items():
+        if isinstance(v, bytes):
+            metadata[k] = v.decode('latin-1')
+        elif isinstance(v, list):
+            metadata[k] = [s.decode('latin-1') if isinstance(s, bytes) else s for s in v]
+
+
+def _encode_header_text(value):
+    """Encode a header text field (or list, such as species) back to the Latin-1 bytes it was decoded from"""
+    if isinstance(value, list):
+        value = ', '.join(value)
+    return (value or u'').encode('latin-1', 'replace')
+
+
+class NightArchiveWriter(object):
+    """Interface for writing a night archive.
+
+    with NightArchiveWriter(outfname) as out:
+        out.add(zc)
+    """
+
+    def __init__(self, fname):
+        self.fname = fname
+        self._f = io.open(fname, 'wb')
+        self._f.write(struct.pack(HEADER_FMT, MAGIC, VERSION, 0, 0))  # placeholder, until we close
+        self._pos = HEADER_SIZE
+        self._index = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__, self.fname)
+
+    def _pad(self):
+        padding = _align(self._pos) - self._pos
+        self._f.write('\0' * padding)
+        self._pos += padding
+
+    def _write(self, data):
+        self._f.write(data)
+        self._pos += len(data)
+
+    def add(self, zc, name=None):
+        """Append a ZeroCross sequence. It is named after its source file unless `name` is given."""
+        md = zc.metadata
+        name = name or md.get('filename', '') or 'sequence%d' % len(self._index)
+        intervals_us = zc.to_intervals_us().astype('<u4')
+
+        flags, meta = 0, {}
+        for k, v in md.items():
+            if k != 'timestamp' and isinstance(v, (basestring, int, float, bool, list)):
+                meta[k] = v
+
+        # encode everything before writing anything, so a failure leaves the archive intact
+        chunks = [intervals_us.tobytes()]
+        if zc.supports_amplitude:
+            flags |= FLAG_AMPLITUDES
+            quantized, meta['amplitude_scale'] = quantize_amplitudes(zc.amplitudes)
+            quantized[1:] -= quantized[:-1].copy()  # delta-code, wrapping modulo 2**16
+            chunks.append(quantized.tobytes())
+        if zc.status is not None:
+            flags |= FLAG_STATUS
+            chunks.append(np.asarray(zc.status, dtype=np.uint8).tobytes())
+        meta = json.dumps(meta).encode('utf-8')
+        chunks.append(meta)
+
+        self._pad()
+        offset = self._pos
+        for chunk in chunks:
+            self._write(chunk)
+
+        self._index.append((_to_us(md.get('timestamp', None)), offset, len(zc), flags, len(meta), name[:36]))
+
+    def close(self):
+        """Write the index and header, then close the outfile."""
+        index = np.array(self._index, dtype=INDEX_DTYPE)
+        index = index[np.argsort(index['timestamp_us'], kind='mergesort')]
+        self._pad()
+        index_offset = self._pos
+        self._write(index.tobytes())
+        self._f.seek(0)
+        self._f.write(struct.pack(HEADER_FMT, MAGIC, VERSION, len(index), index_offset))
+        self._f.close()
+
+
+class NightArchive(object):
+    """Read-only, memory-mapped access to a night archive.
+
+    with NightArchive(fname) as archive:
+        zc = archive[0]
+        zc = archive.get('M7122036.45#')
+        for zc in archive.between(start_datetime, end_datetime):
+            pass
+    """
+
+    def __init__(self, fname):
+        self.fname = fname
+        self._f = open(fname, 'rb')
+        self._m = mmap.mmap(self._f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, count, index_offset = struct.unpack_from(HEADER_FMT, self._m)
+        if magic != MAGIC:
+            raise ValueError('Not a ZCANT night archive: %s' % fname)
+        if version > VERSION:
+            raise ValueError('Unsupported night archive version %d: %s' % (version, fname))
+        self.index = np.frombuffer(self._m, INDEX_DTYPE, count, index_offset).copy()  # copy, so we may unmap
+        self._names = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__, self.fname)
+
+    def __len__(self):
+        return len(self.index)
+
+    @property
+    def names(self):
+        return [name.decode('utf-8') for name in self.index['name']]
+
+    @property
+    def timestamps(self):
+        return [_from_us(ts) for ts in self.index['timestamp_us']]
+
+    def __getitem__(self, i):
+        """Decode the i'th sequence (in timestamp order) to a compact ZeroCross"""
+        timestamp_us, offset, dots, flags, meta_length, name = self.index[i]
+        offset, dots = int(offset), int(dots)
+
+        ticks_us = np.cumsum(np.frombuffer(self._m, '<u4', dots, offset), dtype=np.int64)
+        offset += 4 * dots
+
+        amplitudes = status = None
+        if flags & FLAG_AMPLITUDES:
+            quantized = np.cumsum(np.frombuffer(self._m, '<u2', dots, offset), dtype=np.uint16)
+            offset += quantized.nbytes
+        if flags & FLAG_STATUS:
+            status = np.frombuffer(self._m, np.uint8, dots, offset).copy()
+            offset += dots
+        metadata = json.loads(self._m[offset:offset+meta_length].decode('utf-8'))
+        if flags & FLAG_AMPLITUDES:
+            amplitudes = dequantize_amplitudes(quantized, metadata.pop('amplitude_scale'))
+        metadata['timestamp'] = _from_us(timestamp_us)
+
+        freqs_hz = _freqs(ticks_us * 1e-6, metadata.get('divratio', 16))
+        return ZeroCross(ticks_us, freqs_hz, amplitudes, metadata, status, resolution=1e-6)
+
+    def get(self, name):
+        """Decode the sequence with the specified name, or produce None"""
+        if self._names is None:
+            self._names = dict((n, i) for i, n in enumerate(self.names))
+        i = self._names.get(name, None)
+        return self[i] if i is not None else None
+
+    def between(self, start, end):
+        """Decode all sequences whose timestamp falls within [start, end) datetimes"""
+        start_i, end_i = np.searchsorted(self.index['timestamp_us'], [_to_us(start), _to_us(end)])
+        return [self[i] for i in range(start_i, end_i)]
+
+    def close(self):
+        self._m.close()
+        self._f.close()
+
+
+@print_timing
+def pack_anabat(fname, paths):
+    """Pack the specified Anabat files into a new night archive. Produces the count packed."""
+    count = 0
+    with NightArchiveWriter(fname) as out:
+        for path in paths:
+            try:
+                times, freqs, amplitudes, status, metadata = extract_anabat_dots(path, hpfilter_khz=0)
+                metadata.pop('guano', None)
+                _decode_header_text(metadata)
+                metadata['filename'] = os.path.basename(path)
+                out.add(ZeroCross(times, freqs, amplitudes, metadata, status))
+            except Exception:
+                log.exception('Failed packing %s', path)
+                continue
+            count += 1
+    return count
+
+
+@print_timing
+def unpack_anabat(fname, outdir):
+    """Write each sequence of a night archive to an Anabat file in `outdir`, with the header fields
+    it was packed with. Produces the count."""
+    with NightArchive(fname) as archive:
+        for i, name in enumerate(archive.names):
+            zc = archive[i]
+            md = zc.metadata
+            header = dict((k, _encode_header_text(md.get(k, None))) for k in ('tape', 'loc', 'species', 'spec', 'note1', 'note2'))
+            guano = None
+            if zc.supports_amplitude:
+                guano = GuanoFile()
+                guano['ZCANT|Amplitudes'] = zc.amplitudes
+            with AnabatFileWriter(os.path.join(outdir, os.path.basename(name))) as out:
+                out.write_header(md['timestamp'], md.get('divratio', 16), id_code=_encode_header_text(md.get('id', None)),
+                                 guano=guano, **header)
+                out.write_intervals(zc.to_intervals_us(), zc.status)
+        return len(archive)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m zcant.archive', description='Pack or unpack ZCANT night archives')
+    subparsers = parser.add_subparsers(dest='command')
+    pack = subparsers.add_parser('pack', help='pack a directory of Anabat files into an archive')
+    pack.add_argument('archive')
+    pack.add_argument('dir')
+    unpack = subparsers.add_parser('unpack', help='unpack an archive to Anabat files')
+    unpack.add_argument('archive')
+    unpack.add_argument('outdir')
+    ls = subparsers.add_parser('list', help='list the sequences in an archive')
+    ls.add_argument('archive')
+    args = parser.parse_args(argv)
+
+    if args.command == 'pack':
+        print('Packed %d files' % pack_anabat(args.archive, find_anabat_files(args.dir)))
+    elif args.command == 'unpack':
+        print('Unpacked %d files' % unpack_anabat(args.archive, args.outdir))
+    elif args.command == 'list':
+        with NightArchive(args.archive) as archive:
+            for name, timestamp, dots in zip(archive.names, archive.timestamps, archive.index['dots']):
+                print('%s\t%s\t%d' % (timestamp or '', name, dots))
+
+
+if __name__ == '__main__':
+    # python -m zcant.archive
+    main()
@@ -0,0 +1,333 @@
+"""
+Caches of converted `ZeroCross` results.
+
+`ZeroCrossCache` is a session cache, in memory. Entries are keyed by a file's path, modification
+time, size, and the conversion parameters which affect it, so an edited file or a changed parameter
+is never served stale. The least recently used entries are evicted to keep the total size of cached
+arrays within a byte budget.
+
+`DiskCache` persists converted .WAV files across sessions, as uncompressed .npy arrays which are
+memory-mapped (if large) when reloaded. Its entries are keyed by a fingerprint of the file's content (so
+renaming a file doesn't defeat it) and its modification time (since the fingerprint only samples
+the content) plus the conversion parameters, and are likewise evicted least recently used first
+to stay within a total size.
+
+---------------
+Myotisoft ZCANT
+Copyright (C) 2012-2017 Myotisoft LLC, all rights reserved.
+You may use, distribute, and modify this code under the terms of the MIT License.
+"""
+
+import os
+import os.path
+import json
+import shutil
+import hashlib
+import tempfile
+from threading import Lock
+from datetime import datetime
+from collections import OrderedDict
+
+import numpy as np
+
+import logging
+log = logging.getLogger(__name__)
+
+
+__all__ = 'ZeroCrossCache', 'DiskCache', 'cache_key', 'load_array'
+
+
+ANABAT_PARAMS = 'hpfilter_khz',  # the only conversion parameters which affect Anabat files
+MMAP_MIN_BYTES = 1024 * 1024     # smaller arrays are read rather than mapped, as each mapping holds a file descriptor
+MAX_MAPPED = 128                 # memory-mapped arrays held by a `ZeroCrossCache`, well within typical fd limits
+
+
+def load_array(fname):
+    """Load an .npy array, memory-mapping it only if it's large"""
+    if os.path.getsize(fname) < MMAP_MIN_BYTES:
+        return np.load(fname)
+    return np.load(fname, mmap_mode='r')
+
+
+def cache_key(path, **kwargs):
+    """Produce the cache key for converting `path` with the specified conversion parameters"""
+    st = os.stat(path)
+    if not path.lower().endswith('.wav'):
+        kwargs = dict((k, v) for k, v in kwargs.items() if k in ANABAT_PARAMS)
+    return os.path.abspath(path), st.st_mtime, st.st_size, tuple(sorted(kwargs.items()))
+
+
+class ZeroCrossCache(object):
+    """Thread-safe, memory-bounded LRU cache of `ZeroCross` objects.
+
+    Besides bytes, the count of memory-mapped arrays held is bounded, since each holds open a
+    file descriptor.
+
+    cache = ZeroCrossCache(max_bytes=256*1024*1024)
+    key = cache_key(path, **kwargs)
+    zc = cache.get(key)
+    if zc is None:
+        zc = load_zerocross(path, **kwargs)
+        cache.put(key, zc)
+    """
+
+    def __init__(self, max_bytes=256*1024*1024, disk=None, max_mapped=MAX_MAPPED):
+        """
+        :param max_bytes: memory budget
+        :param disk: optional `DiskCache`, consulted upon a miss and written through upon `put()`
+        :param max_mapped: maximum count of memory-mapped arrays held
+        """
+        self.max_bytes = max_bytes
+        self.max_mapped = max_mapped
+        self.disk = disk
+        self.nbytes = 0
+        self.mapped = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> (zc, nbytes, mapped), least recently used first
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __repr__(self):
+        return '%s(%d entries, %.1f of %.1f MB, %d hits, %d misses)' % (
+            self.__class__.__name__, len(self), self.nbytes / 1048576.0, self.max_bytes / 1048576.0, self.hits, self.misses)
+
+    def get(self, key):
+        """Produce the cached `ZeroCross` for a key, or None"""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+        if entry is None:
+            zc = self.disk.get(key) if self.disk is not None else None
+            if zc is not None:
+                self.put(key, zc, persist=False)
+            return zc
+        with self._lock:
+            self.hits += 1
+            zc, nbytes, mapped = entry
+            # derived values (slopes, etc.) may have been memoized since we cached it
+            self.nbytes += zc.nbytes - nbytes
+            self._entries[key] = zc, zc.nbytes, mapped
+            self._evict()
+            return zc
+
+    def put(self, key, zc, persist=True):
+        """Cache a `ZeroCross`, evicting older entries as necessary to fit within our budget.
+        Unless `persist` is False, it's also written through to disk; see `persist()`.
+        """
+        if persist:
+            self.persist(key, zc)
+        nbytes, mapped = zc.nbytes, zc.mapped
+        with self._lock:
+            self._pop(key)
+            if nbytes > self.max_bytes:
+                log.debug('Not caching %s, which alone exceeds our budget (%d bytes)', key[0], nbytes)
+                return
+            self._entries[key] = zc, nbytes, mapped
+            self.nbytes += nbytes
+            self.mapped += mapped
+            self._evict()
+
+    def persist(self, key, zc):
+        """Write a `ZeroCross` through to our disk cache, if we have one"""
+        if self.disk is not None:
+            self.disk.put(key, zc)
+
+    def _pop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.nbytes -= entry[1]
+            self.mapped -= entry[2]
+        return entry
+
+    def _evict(self):
+        while (self.nbytes > self.max_bytes or self.mapped > self.max_mapped) and len(self._entries) > 1:
+            key = next(iter(self._entries))
+            nbytes = self._pop(key)[1]
+            log.debug('Evicted %s from cache (%d bytes)', key[0], nbytes)
+
+    def remove(self, key):
+        """Remove a single entry, if present"""
+        with self._lock:
+            self._pop(key)
+
+    def discard(self, path):
+        """Remove every entry for a file, regardless of its conversion parameters"""
+        path = os.path.abspath(path)
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == path]:
+                self._pop(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+            self.mapped = 0
+
+
+DISK_CACHE_DIR = '~/.myotisoft/zcant/cache'
+DISK_CACHE_VERSION = 1  # bump whenever conversion output changes, to invalidate old entries
+FINGERPRINT_SAMPLE = 64 * 1024  # bytes hashed from each of the start, middle, and end of a file
+ARRAYS = 'times', 'freqs', 'amplitudes', 'status'
+TIMESTAMP_FMT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+def fingerprint(path):
+    """Fingerprint a file's content cheaply, by hashing its size and samples of its start, middle, and end"""
+    size = os.path.getsize(path)
+    h = hashlib.sha1(str(size).encode('ascii'))
+    with open(path, 'rb') as f:
+        for offset in sorted(set([0, max(size // 2 - FINGERPRINT_SAMPLE // 2, 0), max(size - FINGERPRINT_SAMPLE, 0)])):
+            f.seek(offset)
+            h.update(f.read(FINGERPRINT_SAMPLE))
+    return h.hexdigest()
+
+
+class DiskCache(object):
+    """Persistent, size-bounded cache of converted .WAV files.
+
+    Each entry is a directory holding one .npy file per array plus `metadata.json`. An entry's
+    directory modification time records when it was last used.
+    """
+
+    def __init__(self, root=DISK_CACHE_DIR, max_bytes=2*1024*1024*1024):
+        self.root = os.path.expanduser(root)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._fingerprints = {}  # (path, mtime, size) -> content fingerprint
+        self._sizes = None       # entry directory -> bytes, scanned upon our first write
+        self._lock = Lock()
+
+    def __repr__(self):
+        return '%s(%s, %d hits, %d misses)' % (self.__class__.__name__, self.root, self.hits, self.misses)
+
+    def _entry_dir(self, key):
+        """Produce the entry directory for a `cache_key()`, or None if we don't cache this file"""
+        path, mtime, size, params = key
+        if not path.lower().endswith('.wav'):
+            return None  # Anabat files are already quick to read
+        with self._lock:
+            fp = self._fingerprints.get((path, mtime, size))
+        if fp is None:
+            fp = fingerprint(path)
+            with self._lock:
+                self._fingerprints[(path, mtime, size)] = fp
+        digest = hashlib.sha1(('%d %s %r %r' % (DISK_CACHE_VERSION, fp, mtime, params)).encode('utf-8')).hexdigest()
+        return os.path.join(self.root, digest[:2], digest)
+
+    def get(self, key):
+        """Produce the cached `ZeroCross` for a `cache_key()`, memory-mapped, or None"""
+        from zcant.core import ZeroCross
+        try:
+            entry = self._entry_dir(key)
+            if entry is None:
+                return None
+            if not os.path.isdir(entry):
+                with self._lock:
+                    self.misses += 1
+                return None
+            with open(os.path.join(entry, 'metadata.json'), 'r') as f:
+                metadata = json.load(f)
+            arrays = {}
+            for name in ARRAYS:
+                fname = os.path.join(entry, name + '.npy')
+                arrays[name] = load_array(fname) if os.path.exists(fname) else None
+            os.utime(entry, None)  # most recently used
+        except (OSError, IOError, ValueError):
+            log.exception('Failed reading disk cache entry for %s', key[0])
+            return None
+        if metadata.get('timestamp'):
+            metadata['timestamp'] = datetime.strptime(metadata['timestamp'], TIMESTAMP_FMT)
+        metadata['path'], metadata['filename'] = key[0], os.path.basename(key[0])
+        with self._lock:
+            self.hits += 1
+        return ZeroCross(arrays['times'], arrays['freqs'], arrays['amplitudes'], metadata, arrays['status'])
+
+    def put(self, key, zc):
+        """Persist a `ZeroCross` for a `cache_key()`, evicting older entries to stay within our size"""
+        if 'Gate' in (zc.metadata.get('provenance', None) or {}):
+            return  # gated for display, not the full conversion
+        try:
+            entry = self._entry_dir(key)
+            if entry is None or os.path.isdir(entry):
+                return
+            metadata = {}
+            for k, v in zc.metadata.items():
+                if isinstance(v, datetime):
+                    metadata[k] = v.strftime(TIMESTAMP_FMT)
+                elif v is None or isinstance(v, (basestring, int, float, bool, list, dict)):
+                    metadata[k] = v
+            parent = os.path.dirname(entry)
+            if not os.path.isdir(parent):
+                os.makedirs(parent)
+            tmp = tempfile.mkdtemp(prefix='.tmp-', dir=parent)  # write completely, then rename into place
+            nbytes = 0
+            for name in ARRAYS:
+                array = zc.times if name == 'times' else getattr(zc, name)
+                if array is not None:
+                    np.save(os.path.join(tmp, name + '.npy'), np.ascontiguousarray(array))
+                    nbytes += array.nbytes
+            with open(os.path.join(tmp, 'metadata.json'), 'w') as f:
+                json.dump(metadata, f)
+            os.rename(tmp, entry)
+        except (OSError, IOError):
+            log.exception('Failed writing disk cache entry for %s', key[0])
+            return
+        with self._lock:
+            try:
+                self._scan()
+                self._sizes[entry] = nbytes
+                self._evict()
+            except (OSError, IOError):
+                log.exception('Failed maintaining disk cache %s', self.root)
+
+    def _scan(self):
+        """Tally the size of every existing entry, once. Anything which isn't an entry is ignored."""
+        if self._sizes is not None:
+            return
+        self._sizes = {}
+        if not os.path.isdir(self.root):
+            return
+        for prefix in os.listdir(self.root):
+            prefix = os.path.join(self.root, prefix)
+            if not os.path.isdir(prefix):
+                continue  # eg. .DS_Store
+            for name in os.listdir(prefix):
+                entry = os.path.join(prefix, name)
+                if not os.path.isdir(entry):
+                    continue
+                try:
+                    if name.startswith('.tmp-'):
+                        shutil.rmtree(entry, ignore_errors=True)  # abandoned by a crash
+                    else:
+                        self._sizes[entry] = sum(os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry))
+                except OSError:
+                    log.exception('Failed scanning disk cache entry %s', entry)
+
+    def _evict(self):
+        total = sum(self._sizes.values())
+        if total <= self.max_bytes:
+            return
+        def last_used(entry):
+            try:
+                return os.path.getmtime(entry)
+            except OSError:
+                return 0
+        for entry in sorted(self._sizes, key=last_used):
+            if total <= self.max_bytes:
+                break
+            log.debug('Evicting %s from disk cache', entry)
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= self._sizes.pop(entry)
+
+    def clear(self):
+        with self._lock:
+            shutil.rmtree(self.root, ignore_errors=True)
+            self._sizes = None
@@ -36,6 +36,11 @@ __all__ = 'wav2zc'
 #     return i1 - val1 * ((i2 - i1) / float(val2 - val1))
 
 
+PREVIEW_STRIDE = 8     # samples per amplitude sample, when estimating amplitudes for a preview
+CHUNK_SECS = 1.0       # length of each chunk of a chunked conversion
+HPF_PAD_CYCLES = 100   # overlap (in cycles of the cutoff frequency) filtered beyond each end of a chunk
+
+
 @print_timing
 def rms(signal):
     """Calculate the Root-Mean-Square (RMS) value of a signal"""
@@ -269,43 +274,97 @@ def calculate_amplitudes(signal, crossings):
 
 
 @print_timing
-def zero_cross(signal, samplerate, divratio, amplitudes=True, interpolation=False):
-    """Produce (times in seconds, frequencies in Hz, and amplitudes) from calculated zero crossings"""
-    log.debug('zero_cross(..., %d, %d, amplitudes=%s, interpolation=%s)', samplerate, divratio, amplitudes, interpolation)
-    divratio //= 2  # required so that our algorithm agrees with the Anabat ZCAIM algorithm
-
-    crossings = np.where(np.diff(np.sign(signal)))[0][::divratio*2]  # indexes
-    log.debug('Extracted %d crossings' % len(crossings))
-
-    if amplitudes:
-        amplitudes = calculate_amplitudes(signal, crossings)
-        log.debug('Extracted %d amplitude values' % len(amplitudes))
-    else:
-        amplitudes = None
-
-    if interpolation:
-        crossings = interpolate(signal, crossings)
-
-    times_s = crossings / samplerate
-    intervals_s = np.ediff1d(times_s, to_end=0)  # TODO: benchmark, `diff` may be faster than `ediff1d` (but figure out if the 0 appended to end is necessary?)
-    freqs_hz = 1.0 / intervals_s * divratio
-    freqs_hz[np.isinf(freqs_hz)] = 0  # fix divide-by-zero
-
-    # if not np.all(freqs_hz):
-    #     bad_crossings = np.where(freqs_hz == 0.0)
-    #     log.debug('Discarding %d bad crossings of 0Hz', len(bad_crossings))
-    #     log.debug('  Before: %s', freqs_hz)
-    #     freqs_hz = np.delete(freqs_hz, bad_crossings)
-    #     times_s = np.delete(times_s, bad_crossings)
-    #     amplitudes = np.delete(amplitudes, bad_crossings) if amplitudes is not None else None
-    #     log.debug('   After: %s', freqs_hz)
-    # else:
-    #     log.debug('No bad crossings!')
-    #     log.debug(freqs_hz)
+def estimate_amplitudes(signal, crossings, stride=PREVIEW_STRIDE):
+    """Quickly estimate the amplitudes of `calculate_amplitudes()`, from only every `stride`'th sample"""
+    if not len(crossings):
+        return np.zeros(0)
+    starts = np.append(0, crossings[:-1])
+    cumsum = np.append(0.0, np.cumsum(np.abs(signal[::stride]), dtype=np.float64))
+    first, last = -(-starts // stride), -(-crossings // stride)  # subsampled range of each chunk (ceiling division)
+    counts = last - first
+    estimates = (cumsum[last] - cumsum[first]) / np.maximum(counts, 1)
+    # a chunk shorter than our stride may not contain any subsampled sample at all
+    return np.where(counts > 0, estimates, np.abs(signal[starts]))
+
 
+@print_timing
+def zero_cross(signal, samplerate, divratio, amplitudes=True, interpolation=False, amplitude_stride=None):
+    """Produce (times in seconds, frequencies in Hz, and amplitudes) from calculated zero crossings.
+    If `amplitude_stride` is specified, amplitudes are only estimated (see `estimate_amplitudes()`).
+    This is `zero_cross_chunks()` applied to the whole signal as a single chunk.
+    """
+    log.debug('zero_cross(..., %d, %d, amplitudes=%s, interpolation=%s)', samplerate, divratio, amplitudes, interpolation)
+    chunks = zero_cross_chunks(signal, samplerate, divratio, amplitudes=amplitudes, interpolation=interpolation,
+                               amplitude_stride=amplitude_stride, chunk_secs=None)
+    times_s, freqs_hz, amplitudes, _ = next(chunks)
     return times_s, freqs_hz, amplitudes
 
 
+def zero_cross_chunks(signal, samplerate, divratio, hpfilter_hz=None, amplitudes=True, interpolation=False,
+                      amplitude_stride=None, chunk_secs=CHUNK_SECS):
+    """Zero-cross a signal a chunk at a time, high-pass filtering each chunk as we go.
+    Generates (times in seconds, frequencies in Hz, amplitudes, fraction complete) for each chunk.
+    If `chunk_secs` is None, the whole signal is a single chunk.
+
+    Each chunk is filtered along with an overlap either side of it, which is then discarded, so
+    the filter's edge effects don't appear at chunk boundaries. Samples since the last crossing are
+    carried over into the next chunk, and the last dot of each chunk is only produced with the next
+    chunk, once its frequency (the interval to the following crossing) is known.
+    """
+    half = divratio // 2  # required so that our algorithm agrees with the Anabat ZCAIM algorithm
+    step = half * 2
+    n = len(signal)
+    chunk_len = max(int(chunk_secs * samplerate), 1) if chunk_secs else max(n, 1)
+    pad = int(HPF_PAD_CYCLES * samplerate / hpfilter_hz) if hpfilter_hz else 0
+
+    carry = np.zeros(0)   # samples since the last crossing
+    carry_offset = 0      # index within `signal` of carry[0]
+    seen = 0              # count of sign changes so far
+    pending = None        # (position, amplitude) of the last crossing, awaiting the next one
+    for start in range(0, max(n, 1), chunk_len):
+        end = min(start + chunk_len, n)
+        if hpfilter_hz:
+            lo, hi = max(start - pad, 0), min(end + pad, n)
+            filtered = highpassfilter(signal[lo:hi], samplerate, hpfilter_hz)[start-lo:end-lo]
+        else:
+            filtered = signal[start:end]
+        work = np.concatenate((carry, filtered))
+        changes = np.where(np.diff(np.sign(work)))[0]
+        changes = changes[changes >= len(carry) - 1]  # those within the carry were already seen
+        crossings = changes[(-seen) % step::step]
+        seen += len(changes)
+
+        if not amplitudes:
+            amps = np.zeros(len(crossings))
+        elif amplitude_stride:
+            amps = estimate_amplitudes(work, crossings, amplitude_stride)
+        else:
+            amps = calculate_amplitudes(work, crossings)
+        positions = interpolate(work, crossings) if interpolation else crossings.astype(np.float64)
+        positions += carry_offset
+
+        if len(crossings):
+            carry_offset += crossings[-1]
+            carry = work[crossings[-1]:]
+        else:
+            carry = work
+        if pending is not None:
+            positions, amps = np.append(pending[0], positions), np.append(pending[1], amps)
+
+        final = end >= n
+        if not final and len(positions):
+            pending = positions[-1], amps[-1]
+        times_s = positions / samplerate
+        with np.errstate(divide='ignore'):
+            freqs_hz = half / np.diff(times_s)
+        freqs_hz[np.isinf(freqs_hz)] = 0  # fix divide-by-zero
+        if final:
+            freqs_hz = np.append(freqs_hz, 0.0) if len(times_s) else freqs_hz
+        else:
+            times_s, amps = times_s[:-1], amps[:-1]
+        yield times_s, freqs_hz, amps if amplitudes else None, end / n if n else 1.0
+
+
 @print_timing
 def hpf_zc(times_s, freqs_hz, amplitudes, cutoff_freq_hz):
     """Brickwall high-pass filter for zero-cross signals (simply discards everything < cutoff)"""
@@ -326,13 +385,16 @@ def hpf_zc(times_s, freqs_hz, amplitudes, cutoff_freq_hz):
 
 
 @print_timing
-def wav2zc(fname, divratio=8, hpfilter_khz=20, threshold_factor=1.0, interpolation=False, brickwall_hpf=True):
+def wav2zc(fname, divratio=8, hpfilter_khz=20, threshold_factor=1.0, interpolation=False, brickwall_hpf=True, checkpoint=None,
+           preview=False, progress=None):
     """Convert a single .wav file to Anabat format.
     Produces (times in seconds, frequencies in Hz, amplitudes, metadata).
 
     Processing pipeline:
         signal -> HPF -> ZC w. interpolation -> brickwall HPF -> noise gate
 
+    The HPF, ZC, and brickwall HPF stages are performed a chunk at a time (see `zero_cross_chunks()`).
+
     (We formerly applied noise gate to the full-spectrum signal, but that makes sample
     interpolation impossible(?). Zero-crossing without noise gate is slow, and slows down
     everything later in the pipeline... TODO: investigate other ways to clean up the signal
@@ -344,6 +406,11 @@ def wav2zc(fname, divratio=8, hpfilter_khz=20, threshold_factor=1.0, interpolati
     threshold_factor: RMS multiplier for noise floor, applied after filter
     interpolate: use experimental dot interpolation or not (TODO: use upsampling instead)
     brickwall_hpf: whether we should throw out all dots which fall below our HPF threshold
+    checkpoint: optional callable, called between pipeline stages, which may raise to abandon conversion
+    preview: quickly produce an approximation, without interpolation and with estimated amplitudes;
+             its metadata is marked `preview`
+    progress: optional callable, called with (times, freqs, amplitudes, fraction complete) of each
+              chunk as it's converted, before the noise gate
     """
 
     log.debug('wav2zc(infile=%s, divratio=%d, hpf=%.1fKHz, threshold=%.1fxRMS, interpolate=%s)', fname, divratio, hpfilter_khz, threshold_factor, interpolation)
@@ -352,19 +419,29 @@ def wav2zc(fname, divratio=8, hpfilter_khz=20, threshold_factor=1.0, interpolati
     if divratio not in (4, 8, 10, 16, 32):
         raise Exception('Unsupported divratio: %s (Anabat132 supports 4, 8, 10, 16, 32)' % divratio)
 
+    checkpoint = checkpoint or (lambda: None)
+
     samplerate, signal = load_wav(fname)
+    checkpoint()
 
-    if do_hpfilter:
-        signal = highpassfilter(signal, samplerate, hpfilter_khz*1000)
-    else:
+    if not do_hpfilter:
         # HPF removes DC offset, so we manually remove it when not filtering
-        log.debug('DC offset before: %.1f', np.sum(signal) / len(signal))
         signal = dc_offset(signal)
-        log.debug('DC offset after:  %.1f', np.sum(signal) / len(signal))
+        checkpoint()
+
+    chunks = []
+    for chunk in zero_cross_chunks(signal, samplerate, divratio, hpfilter_khz*1000 if do_hpfilter else None,
+                                   interpolation=interpolation and not preview,
+                                   amplitude_stride=PREVIEW_STRIDE if preview else None):
+        times_s, freqs_hz, amplitudes, fraction = chunk
+        if brickwall_hpf and do_hpfilter and len(freqs_hz):
+            times_s, freqs_hz, amplitudes = hpf_zc(times_s, freqs_hz, amplitudes, hpfilter_khz*1000)
+        chunks.append((times_s, freqs_hz, amplitudes))
+        if progress:
+            progress(times_s, freqs_hz, amplitudes, fraction)
+        checkpoint()
+    times_s, freqs_hz, amplitudes = [np.concatenate(arrays) for arrays in zip(*chunks)]
 
-    times_s, freqs_hz, amplitudes = zero_cross(signal, samplerate, divratio, interpolation=interpolation)
-    if brickwall_hpf and do_hpfilter:
-        times_s, freqs_hz, amplitudes = hpf_zc(times_s, freqs_hz, amplitudes, hpfilter_khz*1000)
     if do_noise_gate:
         times_s, freqs_hz, amplitudes = noise_gate_zc(times_s, freqs_hz, amplitudes, threshold_factor)
 
@@ -376,6 +453,8 @@ def wav2zc(fname, divratio=8, hpfilter_khz=20, threshold_factor=1.0, interpolati
     log.debug('%s\tDots: %d\tMinF: %.1f\tMaxF: %.1f', os.path.basename(fname), len(freqs_hz), min_, max_)
 
     metadata = dict(divratio=divratio, timestamp=extract_timestamp(fname))
+    if preview:
+        metadata['preview'] = True
     return times_s, freqs_hz, amplitudes, metadata
 
 
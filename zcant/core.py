@@ -8,12 +8,19 @@ You may use, distribute, and modify this code under the terms of the MIT License
 """
 
 import os.path
-from bisect import bisect
-from threading import Thread
-
-from zcant import print_timing
-from zcant.anabat import extract_anabat, AnabatFileWriter
-from zcant.conversion import wav2zc
+import stat
+import time
+import tempfile
+from threading import Thread, Condition
+from datetime import datetime
+from collections import OrderedDict
+
+from zcant import __version__, print_timing
+from zcant.anabat import extract_anabat_header, extract_anabat_dots, AnabatFileWriter
+from zcant.conversion import wav2zc, rms
+from zcant.pulses import extract_pulses
+from zcant.pyramid import ZeroCrossPyramid
+from zcant.cache import cache_key, fingerprint
 
 from guano import GuanoFile
 
@@ -33,23 +40,83 @@ class ZeroCross(object):
             pass
         subset = zc[:100]
         len(zc)
+
+    Each dot may optionally carry a `DotStatus` in the uint8 `status` array.
+
+    Times may optionally be stored compactly as int64 "ticks" of a fixed `resolution` in seconds
+    (in which case freqs and amplitudes are stored as float32). With a resolution of 1 microsecond,
+    conversion to and from Anabat intervals is exact; see `from_intervals()` and `to_intervals_us()`.
     """
-    def __init__(self, times, freqs, amplitudes, metadata):
+
+    __slots__ = ('_times', '_ticks', 'resolution', 'freqs', 'amplitudes', 'metadata', 'status', 'window',
+                 '_derived', '_base')
+
+    def __init__(self, times, freqs, amplitudes, metadata, status=None, resolution=None):
+        """
+        :param times: dot times in seconds, or int64 ticks if `resolution` is specified
+        :param resolution: store times as ticks of this many seconds (float times are rounded)
+        """
         if len(times) != len(freqs):
             raise ValueError('times (%d) and freqs (%d) disagree' % (len(times), len(freqs)))
         if amplitudes is not None and len(times) != len(amplitudes):
             raise ValueError('times (%d) and amplitudes (%d) disagree' % (len(times), len(amplitudes)))
-        self.times = times
+        if status is not None and len(times) != len(status):
+            raise ValueError('times (%d) and status (%d) disagree' % (len(times), len(status)))
+        if resolution:
+            times = np.asarray(times)
+            ticks = times if times.dtype.kind in 'iu' else np.rint(times / resolution)
+            self._times, self._ticks = None, ticks.astype(np.int64, copy=False)
+            freqs = np.asarray(freqs, dtype=np.float32)
+            amplitudes = np.asarray(amplitudes, dtype=np.float32) if amplitudes is not None else None
+        else:
+            self._times, self._ticks = times, None
+        self.resolution = resolution
         self.freqs = freqs
         self.amplitudes = amplitudes
         self.metadata = metadata
+        self.status = status
+        self.window = None  # (start, end) times, if this is a windowed view
+        self._derived = {}  # memoized derived arrays (log freqs, slopes), keyed by parameters
+        self._base = None   # (root signal, start, stop) if we're a contiguous slice of another signal
+
+    @classmethod
+    def from_intervals(cls, intervals_us, freqs, amplitudes, metadata, status=None):
+        """Create a compact ZeroCross from Anabat microsecond intervals (the first measured from time 0)"""
+        return cls(np.cumsum(intervals_us, dtype=np.int64), freqs, amplitudes, metadata, status, resolution=1e-6)
+
+    def to_intervals_us(self):
+        """Produce the Anabat microsecond intervals between dots (the first measured from time 0)"""
+        if self._ticks is not None and self.resolution == 1e-6:
+            ticks_us = self._ticks
+        else:
+            ticks_us = np.rint(self.times * 1e6).astype(np.int64)
+        return np.ediff1d(ticks_us, to_begin=ticks_us[:1])
 
-    def __getitem__(self, slice):
-        amplitudes = self.amplitudes[slice] if self.supports_amplitude else None
-        return ZeroCross(self.times[slice], self.freqs[slice], amplitudes, self.metadata)
+    def compact(self, resolution=1e-6):
+        """Produce a copy of this signal with compact storage (see class docs)"""
+        return ZeroCross(self.times, self.freqs, self.amplitudes, self.metadata, self.status, resolution)
+
+    @property
+    def times(self):
+        """Dot times in seconds"""
+        return self._times if self._ticks is None else self._ticks * self.resolution
+
+    def __getitem__(self, index):
+        amplitudes = self.amplitudes[index] if self.supports_amplitude else None
+        status = self.status[index] if self.status is not None else None
+        if self._ticks is not None:
+            zc = ZeroCross(self._ticks[index], self.freqs[index], amplitudes, self.metadata, status, self.resolution)
+        else:
+            zc = ZeroCross(self._times[index], self.freqs[index], amplitudes, self.metadata, status)
+        if isinstance(index, slice) and index.step in (None, 1):
+            # contiguous views share (and slice) derived values with the signal they came from
+            start, stop, _ = index.indices(len(self))
+            root, offset = (self._base[0], self._base[1]) if self._base else (self, 0)
+            zc._base = (root, offset + start, offset + stop)
+        return zc
 
     def __len__(self):
-        return len(self.times)
+        return len(self.freqs)
 
     @property
     def supports_amplitude(self):
@@ -59,16 +126,117 @@ class ZeroCross(object):
     @property
     def duration(self):
         """The duration of this signal in seconds"""
-        if self.times is None or len(self.times) < 2:
+        if len(self) < 2:
             return -0
-        return self.times[-1] - self.times[0]
+        return self._time(-1) - self._time(0)
+
+    def _time(self, i):
+        """Time in seconds of the i'th dot, without converting all ticks to times"""
+        return self._times[i] if self._ticks is None else self._ticks[i] * self.resolution
+
+    def _searchsorted(self, t, side='left'):
+        """Index at which time `t` would be inserted to maintain order, as `np.searchsorted()`"""
+        if self._ticks is None:
+            return np.searchsorted(self._times, t, side)
+        tick = t / self.resolution
+        if np.isclose(tick, np.rint(tick)):
+            tick = np.rint(tick)
+        else:
+            tick = np.ceil(tick) if side == 'left' else np.floor(tick)
+        return np.searchsorted(self._ticks, np.int64(tick), side)
 
-    def get_slopes(self, smooth=False, max_slope=5000):
-        """Calculate slope values, optionally smoothing them to reduce noise"""
-        slopes = _slopes(self.times, self.freqs, max_slope)
-        if smooth:
-            slopes = _smooth(slopes)
-        return slopes
+    @property
+    def nbytes(self):
+        """Approximate memory used by our arrays, including memoized derived values and GUANO metadata"""
+        arrays = [self._times, self._ticks, self.freqs, self.amplitudes, self.status] + list(self._derived.values())
+        arrays.append((self.metadata or {}).get('guano', None))
+        return sum(getattr(a, 'nbytes', 0) for a in arrays if a is not None)
+
+    @property
+    def mapped(self):
+        """Count of our arrays which are memory-mapped files (each of which holds a file descriptor)"""
+        return sum(1 for a in (self._times, self._ticks, self.freqs, self.amplitudes, self.status) if isinstance(a, np.memmap))
+
+    def without_status(self, *statuses):
+        """This signal minus any dots having the specified `DotStatus` (eg. `DotStatus.OFF`)"""
+        if self.status is None:
+            return self
+        mask = ~np.in1d(self.status, statuses)
+        return self if mask.all() else self[mask]
+
+    def gated(self, threshold_factor):
+        """This signal minus any dots whose amplitude is below `threshold_factor` times the RMS
+        amplitude, exactly as `zcant.conversion.noise_gate_zc()` would have produced.
+
+        Amplitudes are sorted (once) so that each new threshold is a binary search plus a mask;
+        converting a .WAV without a noise gate and gating it here allows instant threshold changes.
+        The gate is recorded in the `Gate` and `Gate RMS` provenance fields, and a signal which was
+        already gated can only be gated further (the dots it lost are gone).
+        """
+        provenance = self.metadata.get('provenance', None) or {}
+        if not self.supports_amplitude or not len(self) or threshold_factor <= float(provenance.get('Gate', 0.0)):
+            return self
+        if 'amplitude_order' not in self._derived:
+            order = np.argsort(self.amplitudes, kind='mergesort')
+            self._derived['amplitude_order'] = order
+            self._derived['sorted_amplitudes'] = self.amplitudes[order]
+            # an already-gated signal is gated relative to the RMS of the signal it was gated from
+            self._derived['amplitude_rms'] = float(provenance['Gate RMS']) if 'Gate RMS' in provenance else rms(self.amplitudes)
+        order = self._derived['amplitude_order']
+        threshold = threshold_factor * self._derived['amplitude_rms']
+        cut = np.searchsorted(self._derived['sorted_amplitudes'], threshold, side='left')  # count below threshold
+        log.debug('RMS: %.1f  threshold: %0.1f (%.1f x RMS)  gated %d of %d dots',
+                  self._derived['amplitude_rms'], threshold, threshold_factor, cut, len(self))
+        mask = np.ones(len(self), dtype=bool)
+        mask[order[:cut]] = False
+        zc = self[mask]
+        zc.metadata = dict(self.metadata)
+        if provenance:
+            zc.metadata['provenance'] = OrderedDict(provenance)
+            zc.metadata['provenance']['Gate'] = str(threshold_factor)
+            zc.metadata['provenance']['Gate RMS'] = repr(float(self._derived['amplitude_rms']))
+        return zc
+
+    def get_log_freqs(self):
+        """Frequencies in octaves (log2 Hz), or 0 for dots without a valid frequency"""
+        if self._base is not None:
+            root, start, stop = self._base
+            return root.get_log_freqs()[start:stop]
+        if 'log_freqs' not in self._derived:
+            self._derived['log_freqs'] = _octaves(self.freqs)
+        return self._derived['log_freqs']
+
+    def get_slopes(self, smooth=False, max_slope=5000, window=3, time_gap=0.01):
+        """Calculate slope values, optionally smoothing them to reduce noise.
+
+        Smoothing uses a moving average of `window` dots, which doesn't cross pulse boundaries
+        (silence gaps of at least `time_gap` seconds).
+
+        Slopes are calculated only once per signal and set of parameters; windowed views simply
+        slice the values of the signal they were taken from. Don't modify the returned array!
+        """
+        if self._base is not None:
+            root, start, stop = self._base
+            return root.get_slopes(smooth, max_slope, window, time_gap)[start:stop]
+        key = ('slopes', max_slope, window, time_gap) if smooth else ('slopes', max_slope)
+        if key not in self._derived:
+            slopes = _slopes(self.times, self.get_log_freqs(), max_slope)
+            if smooth:
+                slopes = _smooth(slopes, self.get_pulses(time_gap), window)
+            self._derived[key] = slopes
+        return self._derived[key]
+
+    def get_pyramid(self, smooth=False, window=3):
+        """Produce the multi-resolution `ZeroCrossPyramid` of this signal, with slopes calculated as
+        for `get_slopes()`. Windowed views share the pyramid of the signal they came from.
+        """
+        if self._base is not None:
+            return self._base[0].get_pyramid(smooth, window)
+        key = ('pyramid', smooth, window)
+        if key not in self._derived:
+            amplitudes = self.amplitudes if self.supports_amplitude else None
+            self._derived[key] = ZeroCrossPyramid(self.times, self.freqs, self.get_slopes(smooth, window=window), amplitudes)
+        return self._derived[key]
 
     def get_pulses(self, time_gap=0.01):
         """Produce the indexes which mark the start of each pulse (DUMB IMPLEMENTATION!)
@@ -81,77 +249,98 @@ class ZeroCross(object):
         # TODO: check for minimum number of dots in a pulse? max frequency jump between dots?
         return splits
 
+    def get_pulse_table(self, **kwargs):
+        """Segment into pulses, producing a structured array of per-pulse parameters.
+        See `zcant.pulses.extract_pulses()` for the segmentation parameters and `PULSE_DTYPE` for fields.
+        """
+        return extract_pulses(self, **kwargs)
+
     def windowed(self, start, duration):
-        if len(self.times) < 2:
-            return self  # FIXME: shouldn't we instead return an empty ZC if no dots in window?
+        """Produce a view of the dots within the time window [start, start + duration].
 
-        if self.times[-1] - start >= duration:  # normal
-            window_from, window_to = bisect(self.times, start), bisect(self.times, start + duration)
-        elif duration >= self.times[-1]:  # window too big
-            window_from, window_to = 0, len(self.times)-1
-        else:  # EOF
-            window_from, window_to = bisect(self.times, self.times[-1] - duration), len(self.times)-1  # panned to the end
+        The view's arrays are slices of our own (so no copying takes place), and the window bounds
+        are available as its `window` attribute. A window which extends past the end of the signal
+        is panned back to end with the final dot.
+        """
+        if not len(self):
+            return self
+        end = start + duration
+        if end > self._time(-1):  # EOF
+            start = max(self._time(-1) - duration, 0.0)
+            end = start + duration
+        window_from = self._searchsorted(start, 'left')
+        window_to = self._searchsorted(end, 'right')
 
         zc = self[window_from:window_to]
-
-        # because times is sparse, we need to fill in edge cases (unfortunately np.insert, np.append copy rather than view)
-        if len(zc) == 0 or zc.times[0] > start:
-            zc.times, zc.freqs = np.insert(zc.times, 0, start), np.insert(zc.freqs, 0, start)
-            zc.amplitudes = np.insert(zc.amplitudes, 0, start) if zc.supports_amplitude else None
-        if zc.times[-1] < start + duration:
-            zc.times, zc.freqs = np.append(zc.times, start + duration), np.append(zc.freqs, 0)  # this is wrong for END OF FILE case
-            zc.amplitudes = np.append(zc.amplitudes, 0) if zc.supports_amplitude else None  # ?
+        zc.window = (start, end)
 
         log.debug('%.1f sec window:  %s', duration, zc)
         return zc
 
     def __repr__(self):
-        return '<ZeroCross dots=%d duration=%0.2fsec>' % (len(self.times), self.duration)
+        return '<ZeroCross dots=%d duration=%0.2fsec>' % (len(self), self.duration)
 
 
 @print_timing
-def _smooth(slopes):
+def _smooth(slopes, boundaries=None, window=3):
     """
     Smooth slope values to account for the fact that zero-cross conversion may be noisy.
+
+    Each pulse is smoothed independently with a centered moving average, which narrows at the start
+    and end of a pulse rather than reaching across into its neighbors.
     :param slopes: slope values
+    :param boundaries: indexes of the final dot of each pulse (excluding the last), see `get_pulses()`
+    :param window: moving average window size in dots (should be odd)
     :return:
-    TODO: smooth individual pulses independently so we don't smooth across their boundaries
     """
-    WINDOW_SIZE = 3  # hard-coded for now
-    if slopes.size <= WINDOW_SIZE:
-        return np.zeros(slopes.size)
+    n = slopes.size
+    if n == 0:
+        return np.zeros(0)
+    half = max(window, 1) // 2
     # Rather than true convolution, we use a much faster cumulative sum solution
     # http://stackoverflow.com/a/11352216
     # http://stackoverflow.com/a/34387987
     slopes = np.where(np.isnan(slopes), 0, slopes)  # replace NaN values
-    cumsum = np.cumsum(np.insert(slopes, 0, 0))
-    smoothed = (cumsum[WINDOW_SIZE:] - cumsum[:-WINDOW_SIZE]) / WINDOW_SIZE
-    # smoothed is missing element at start and end, so fake 'em
-    smoothed = np.insert(smoothed, 0, smoothed[0])
-    smoothed = np.insert(smoothed, -1, smoothed[-1])
-    return smoothed
+    ends = np.zeros(0, dtype=np.intp) if boundaries is None else np.asarray(boundaries, dtype=np.intp)
+    slopes[ends[ends > 0]] = slopes[ends[ends > 0] - 1]  # slope at a pulse's final dot spans the gap to the next
+    cumsum = np.zeros(n + 1)
+    np.cumsum(slopes, out=cumsum[1:])
+    # a single cumulative sum serves every pulse; we just clamp each window to its own pulse
+    starts = ends + 1
+    pulse = np.zeros(n, dtype=np.intp)
+    pulse[starts] = 1
+    pulse = np.cumsum(pulse)  # pulse number of each dot
+    i = np.arange(n)
+    lo = np.maximum(i - half, np.append(0, starts)[pulse])
+    hi = np.minimum(i + half + 1, np.append(starts, n)[pulse])
+    return (cumsum[hi] - cumsum[lo]) / (hi - lo)
+
+
+def _octaves(y):
+    """Convert frequency values to octaves, with 0 for any zero frequencies"""
+    if not np.any(y):
+        return np.zeros(len(y))
+    # calculation for difference wil be same in Hz or kHz, so no need to convert
+    with np.errstate(divide='ignore'):
+        y_octaves = np.log2(y)
+    y_octaves[~np.isfinite(y_octaves)] = 0.0
+    return y_octaves
 
 
 @print_timing
-def _slopes(x, y, max_slope=5000):
+def _slopes(x, y_octaves, max_slope=5000):
     """
     Produce an array of slope values in octaves per second.
     We very, very crudely try to compensate for the jump between pulses, but don't deal well with noise.
-    :param x:
-    :param y:
+    :param x: times in seconds
+    :param y_octaves: frequencies in octaves (see `_octaves()`)
     :return:
     """
-    if not len(x) or not len(y):
+    if not len(x) or not len(y_octaves):
         return np.array([])
     elif len(x) == 1:
         return np.array([0.0])
 
-    if not np.any(y):
-        y_octaves = y
-    else:
-        # calculation for difference wil be same in Hz or kHz, so no need to convert
-        y_octaves = np.log2(y)  # FIXME: FloatingPointError: divide by zero encountered in log2
-        y_octaves[np.isnan(y_octaves)] = 0.0
     slopes = np.diff(y_octaves) / np.diff(x)
     slopes = np.append(slopes, slopes[-1])  # FIXME: hack for final dot (instead merge slope(signal[1:]) and slope(signal[:-1])
     slopes = np.abs(slopes)  # Analook inverts slope so we do also (but should we keep the distinction between positive and negative slopes??)
@@ -167,89 +356,475 @@ def _slopes(x, y, max_slope=5000):
 
 
 
-class MainThread(Thread):
-    """Main wave-to-zerocross extraction thread"""
+def extract(path, **kwargs):
+    """Extract (times, freqs, amplitudes, status, metadata) from supported filetypes"""
+    ext = os.path.splitext(path)[1].lower()
+    if ext.endswith('#') or ext == '.zc':
+        return extract_anabat_dots(path, **kwargs)
+    elif ext == '.wav':
+        times, freqs, amplitudes, metadata = wav2zc(path, **kwargs)
+        return times, freqs, amplitudes, None, metadata
+    else:
+        raise Exception('Unknown file type: %s', path)
+
+
+CONVERTED_DIR = '_ZCANT_Converted'
+
+# conversion parameters recorded in (and which must match) a converted file's provenance
+PROVENANCE_PARAMS = (('divratio', 'DivRatio'), ('hpfilter_khz', 'HPF'),
+                     ('threshold_factor', 'Threshold'), ('interpolation', 'Interpolation'))
+PROVENANCE_GATE = 'Gate', 'Gate RMS'  # noise gate applied after conversion, see `ZeroCross.gated()`
 
-    def __init__(self, parent_cb, path, **kwargs):
+
+def converted_path(path):
+    """Path where the converted zero-cross output of a .WAV file is saved"""
+    dirname, fname = os.path.split(path)
+    return os.path.join(dirname, CONVERTED_DIR, os.path.splitext(fname)[0] + '.zc')
+
+
+def conversion_provenance(path, **kwargs):
+    """Describe the conversion of a .WAV file with the specified parameters, as `ZCANT|` GUANO fields.
+    Every field must match for converted output to be reused, including the source's modification
+    time: its content fingerprint only samples the file, so would miss some edits in place.
+    """
+    st = os.stat(path)
+    provenance = OrderedDict([
+        ('Source Size', str(st.st_size)),
+        ('Source Modified', datetime.utcfromtimestamp(st.st_mtime).isoformat()),
+        ('Source Hash', fingerprint(path)),
+        ('Version', __version__),
+    ])
+    for param, field in PROVENANCE_PARAMS:
+        if param in kwargs:
+            provenance[field] = str(kwargs[param])
+    return provenance
+
+
+def read_provenance(fname):
+    """Read the conversion provenance recorded in a converted Anabat file (empty if there is none)"""
+    guano = extract_anabat_header(fname, max_guano_bytes=2**20).get('guano', None)
+    if guano is None:
+        return {}
+    return dict((key.split('|', 1)[1], guano[key]) for key in guano.keys() if key.startswith('ZCANT|') and key != 'ZCANT|Amplitudes')
+
+
+def provenance_matches(expected, fname, exact=False):
+    """Was existing file `fname` converted from the same source, with the same parameters, as `expected`?
+    With `exact`, it must also have been gated the same (see `ZeroCross.gated()`).
+    """
+    if not expected or not os.path.exists(fname):
+        return False
+    try:
+        actual = read_provenance(fname)
+    except Exception:
+        log.exception('Failed reading provenance of %s', fname)
+        return False
+    if exact and any(actual.get(k) != expected.get(k) for k in PROVENANCE_GATE):
+        return False
+    return all(actual.get(k) == v for k, v in expected.items() if k not in PROVENANCE_GATE)
+
+
+def load_zerocross(path, extract=extract, checkpoint=None, progress=None, **kwargs):
+    """Load a supported file as a `ZeroCross`, whose metadata includes its `path` and `filename`.
+
+    A .WAV file whose converted output already exists with matching provenance isn't converted
+    again; its output is read instead. Output which was gated (see `ZeroCross.gated()`) is never
+    reused: Anabat files record only the intervals between dots, so the frequencies of dots
+    following a gap can't be recovered.
+
+    An optional `checkpoint` callable is called between conversion stages, and may raise
+    `LoadCancelled` to abandon the load. An optional `progress` callable is called with a partial
+    `ZeroCross` and the fraction complete as each chunk of a .WAV file is converted.
+    """
+    filename = os.path.basename(path)
+    provenance = conversion_provenance(path, **kwargs) if path.lower().endswith('.wav') else None
+    if checkpoint:
+        checkpoint()
+        kwargs['checkpoint'] = checkpoint
+    if provenance and provenance_matches(provenance, converted_path(path), exact=True):
+        log.debug('Reusing converted %s', converted_path(path))
+        times, freqs, amplitudes, status, metadata = extract_anabat_dots(converted_path(path), **kwargs)
+    else:
+        if provenance and progress:
+            def on_chunk(times, freqs, amplitudes, fraction):
+                progress(ZeroCross(times, freqs, amplitudes, dict(path=path, filename=filename)), fraction)
+            kwargs['progress'] = on_chunk
+        times, freqs, amplitudes, status, metadata = extract(path, **kwargs)
+    if provenance:
+        metadata['provenance'] = provenance
+    metadata['path'] = path
+    metadata['filename'] = filename
+    log.debug('    %s:  times: %d  freqs: %d', filename, len(times), len(freqs))
+    return ZeroCross(times, freqs, amplitudes, metadata, status)
+
+
+class LoadCancelled(Exception):
+    """Raised at a conversion checkpoint when a load has been superseded"""
+    pass
+
+
+class Loader(Thread):
+    """Single long-lived loading thread, which only ever works on the most recent request.
+
+    Each `request()` produces a new generation number. A request which is superseded before it
+    starts is simply dropped, and one which is already running is cancelled at its next checkpoint.
+    Only a load which is still current upon completion is reported to `on_complete()`.
+    Results are served from, and added to, the optional `ZeroCrossCache`.
+
+    With `preview`, a .WAV file which isn't cached is first quickly converted as a preview (see
+    `wav2zc()`), which is reported to `on_complete()` before the full conversion begins.
+    With `progress_cb`, each chunk of a full .WAV conversion is reported to `on_progress()`.
+    """
+
+    def __init__(self, parent_cb, cache=None, preview=False, progress_cb=None):
         Thread.__init__(self)
         self.parent_cb = parent_cb
-        self.path = path
-        self.filename = os.path.basename(path)
-        self.kwargs = kwargs
+        self.progress_cb = progress_cb
+        self.cache = cache
+        self.preview = preview
+        self.generation = 0
+        self._request = None
+        self._busy = False
+        self._cond = Condition()
 
         self.setDaemon(True)
         self.start()  # start immediately
 
-    def extract(self, path):
-        """Extract (times, freqs, amplitudes, metadata) from supported filetypes"""
-        ext = os.path.splitext(path)[1].lower()
-        if ext.endswith('#') or ext == '.zc':
-            return extract_anabat(path, **self.kwargs)
-        elif ext == '.wav':
-            return wav2zc(path, **self.kwargs)
-        else:
-            raise Exception('Unknown file type: %s', path)
+    def is_busy(self):
+        """Is a request pending or in progress?"""
+        return self._request is not None or self._busy
 
-    def on_complete(self, result):
-        """Called upon completion of run(), may be overridden by subclasses"""
-        self.parent_cb(result)
+    def request(self, path, **kwargs):
+        """Request that a file be loaded, superseding any earlier request. Produces its generation."""
+        with self._cond:
+            self.generation += 1
+            self._request = self.generation, path, kwargs
+            self._cond.notify()
+            return self.generation
+
+    def cancel(self):
+        """Abandon any pending or running request"""
+        with self._cond:
+            self.generation += 1
+            self._request = None
+
+    def is_current(self, generation):
+        return generation == self.generation
+
+    def on_complete(self, generation, result):
+        """Called upon completion of a current request, may be overridden by subclasses"""
+        self.parent_cb(generation, result)
+
+    def on_progress(self, generation, zc, fraction):
+        """Called with each converted chunk of a current request, may be overridden by subclasses"""
+        self.progress_cb(generation, zc, fraction)
+
+    def load(self, generation, path, kwargs, checkpoint, progress=None):
+        """Produce the `ZeroCross` for a request, may be overridden by subclasses"""
+        return load_zerocross(path, checkpoint=checkpoint, progress=progress, **kwargs)
 
     def run(self):
         """Thread main"""
-        result = None
+        while True:
+            with self._cond:
+                while self._request is None:
+                    self._cond.wait()
+                generation, path, kwargs = self._request
+                self._request = None
+                self._busy = True
+            try:
+                self._run(generation, path, kwargs)
+            finally:
+                self._busy = False
+
+    def _run(self, generation, path, kwargs):
+        """Load a single request"""
+        def checkpoint():
+            if generation != self.generation:
+                raise LoadCancelled()
+
+        def progress(zc, fraction):
+            if self.is_current(generation):
+                self.on_progress(generation, zc, fraction)
+
+        result, persist = None, False
         try:
-            times, freqs, amplitudes, metadata = self.extract(self.path)
+            key = cache_key(path, **kwargs) if self.cache is not None else None
+            result = self.cache.get(key) if key else None
+            if result is None:
+                if self.preview and path.lower().endswith('.wav'):
+                    result = self.load(generation, path, dict(kwargs, preview=True), checkpoint)
+                    checkpoint()
+                    if result.metadata.get('preview', False):
+                        self.on_complete(generation, result)
+                        result = None
+                    # else we reused existing converted output, which is already the real thing
+                if result is None:
+                    result = self.load(generation, path, kwargs, checkpoint, progress if self.progress_cb else None)
+                    checkpoint()
+                if key:
+                    self.cache.put(key, result, persist=False)
+                    persist = True
+        except LoadCancelled:
+            log.debug('Cancelled loading superseded file: %s', path)
+            return
+        except Exception:
+            log.exception('Barfed loading file: %s', path)
 
-            metadata['path'] = self.path
-            metadata['filename'] = self.filename
-            log.debug('    %s:  times: %d  freqs: %d', self.filename, len(times), len(freqs))
+        if self.is_current(generation):
+            self.on_complete(generation, result)
+        if persist:
+            self.cache.persist(key, result)  # only once the result is on its way, as it writes to disk
 
-            result = ZeroCross(times, freqs, amplitudes, metadata)
-        except Exception:
-            log.exception('Barfed loading file: %s', self.path)
 
-        self.on_complete(result)
+class Prefetcher(Thread):
+    """Single low-priority thread which converts files ahead of need, into a `ZeroCrossCache`.
 
+    `prefetch()` replaces the list of files wanted, most wanted first. A fetch waits while the
+    `foreground` `Loader` is busy, and fetching stops once the wanted files fetched so far exceed
+    `max_bytes`. When the conversion parameters change, any fetch in progress is cancelled and
+    everything fetched with the old parameters is dropped from the cache.
+    """
 
-class AnabatFileWriteThread(Thread):
-    """Thread for writing an Anabat-format file"""
+    PAUSE_SECS = 0.05  # how often a paused fetch checks whether the foreground is still busy
 
-    def __init__(self, zc, fname, divratio):
+    def __init__(self, cache, foreground=None, max_bytes=64*1024*1024):
         Thread.__init__(self)
-        self.zc = zc
-        self.fname = fname
-        self.divratio = divratio
+        self.cache = cache
+        self.foreground = foreground
+        self.max_bytes = max_bytes
+        self.generation = 0
+        self._paths = []
+        self._kwargs = None
+        self._fetching = None           # path of the fetch in progress
+        self._fetched = OrderedDict()   # cache key -> bytes, of everything fetched with current parameters
+        self._cond = Condition()
 
         self.setDaemon(True)
         self.start()  # start immediately
 
+    def prefetch(self, paths, **kwargs):
+        """Fetch the specified files (and only those) with the specified conversion parameters"""
+        paths = [os.path.abspath(path) for path in paths]
+        with self._cond:
+            if kwargs != self._kwargs:
+                self.generation += 1
+                for key in self._fetched:
+                    self.cache.remove(key)
+                self._fetched.clear()
+                self._kwargs = kwargs
+            elif self._fetching is not None and self._fetching not in paths:
+                self.generation += 1  # no longer wanted
+            self._paths = paths
+            self._cond.notify()
+
+    def cancel(self):
+        """Abandon every pending and running fetch"""
+        with self._cond:
+            self.generation += 1
+            self._paths = []
+
+    def load(self, generation, path, kwargs, checkpoint):
+        """Produce the `ZeroCross` for a fetch, may be overridden by subclasses"""
+        return load_zerocross(path, checkpoint=checkpoint, **kwargs)
+
+    def _next(self):
+        """Choose the next fetch, as (path, key), or None"""
+        fetched = 0
+        for path in self._paths:
+            try:
+                key = cache_key(path, **self._kwargs)
+            except OSError:
+                continue  # deleted out from under us?
+            if key in self._fetched:
+                fetched += self._fetched[key]
+            elif key not in self.cache:
+                return (path, key) if fetched < self.max_bytes else None
+        return None
+
     def run(self):
-        md = self.zc.metadata
-        timestamp = md.get('timestamp', None)
-        species = md.get('species', '')
-        note1 = md.get('note1', '')
-        if note1:
-            note2 = 'Myotisoft ZCANT'
-        else:
-            note1, note2 = 'Myotisoft ZCANT', ''
-        if self.zc.supports_amplitude:
-            log.debug('Adding GUANO metadata :-)')
-            guano = GuanoFile()
-            guano['ZCANT|Amplitudes'] = self.zc.amplitudes
-        else:
-            log.debug('Not adding GUANO metadata :-(')
-            guano = None
-
-        log.debug('Saving %s ...', self.fname)
-
-        outdir = os.path.dirname(self.fname)
-        if not os.path.exists(outdir):
-            log.debug('Creating outdir %s ...', outdir)
-            os.makedirs(outdir)
-
-        with AnabatFileWriter(self.fname) as out:
-            out.write_header(timestamp, self.divratio, species=species, note1=note1, note2=note2, guano=guano)
-            time_indexes_us = self.zc.times * 1000000
-            intervals_us = np.diff(time_indexes_us)
-            intervals_us = intervals_us.astype(int)  # TODO: round before int cast; consider casting before diff for performance
-            out.write_intervals(intervals_us)
+        """Thread main"""
+        while True:
+            with self._cond:
+                job = self._next()
+                while job is None:
+                    self._cond.wait()
+                    job = self._next()
+                path, key = job
+                generation, kwargs = self.generation, self._kwargs
+                self._fetching = path
+
+            def checkpoint():
+                # yield to the foreground, and give up once superseded
+                while self.foreground is not None and self.foreground.is_busy() and generation == self.generation:
+                    time.sleep(self.PAUSE_SECS)
+                if generation != self.generation:
+                    raise LoadCancelled()
+
+            zc = None
+            try:
+                checkpoint()
+                zc = self.cache.get(key)  # perhaps persisted on disk
+                if zc is None:
+                    zc = self.load(generation, path, kwargs, checkpoint)
+                    checkpoint()
+            except LoadCancelled:
+                log.debug('Cancelled prefetching %s', path)
+            except Exception:
+                log.exception('Failed prefetching %s', path)
+
+            with self._cond:
+                self._fetching = None
+                if generation != self.generation:
+                    continue
+                if zc is not None:
+                    try:
+                        self.cache.put(key, zc)
+                        log.debug('Prefetched %s; %r', path, self.cache)
+                    except Exception:
+                        log.exception('Failed caching prefetched %s', path)  # but keep prefetching
+                        zc = None
+                self._fetched[key] = zc.nbytes if zc is not None else 0  # never retry a failure
+
+
+class AnabatWriteQueue(Thread):
+    """Single background writer of Anabat-format files.
+
+    Saves are queued by path, so a path which is saved again before it's written is written only
+    once, with the latest signal. Each batch of queued files is written to temporary files which
+    are then fsync'd and atomically renamed into place, so a crash never leaves a truncated file.
+    A file whose existing output already has matching provenance isn't rewritten.
+    """
+
+    def __init__(self, maxsize=64):
+        Thread.__init__(self)
+        self.maxsize = maxsize
+        self._pending = OrderedDict()  # fname -> (zc, divratio), oldest first
+        self._busy = False
+        self._cond = Condition()
+
+        self.setDaemon(True)
+        self.start()  # start immediately
+
+    def save(self, zc, fname, divratio):
+        """Queue a signal to be written. Blocks only if the queue is full of other paths."""
+        with self._cond:
+            while len(self._pending) >= self.maxsize and fname not in self._pending:
+                self._cond.wait()
+            self._pending.pop(fname, None)
+            self._pending[fname] = zc, divratio
+            self._cond.notify_all()
+
+    def discard(self, fname):
+        """Cancel any queued write of a path"""
+        with self._cond:
+            self._pending.pop(fname, None)
+            self._cond.notify_all()
+
+    def flush(self):
+        """Block until every queued write is complete"""
+        with self._cond:
+            while self._pending or self._busy:
+                self._cond.wait()
+
+    def run(self):
+        """Thread main"""
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                batch, self._pending = self._pending, OrderedDict()
+                self._busy = True
+                self._cond.notify_all()  # there's room in the queue again
+            try:
+                self._write_batch(batch)
+            except Exception:
+                log.exception('Failed writing %d files', len(batch))
+            finally:
+                with self._cond:
+                    self._busy = False
+                    self._cond.notify_all()
+
+    @print_timing
+    def _write_batch(self, batch):
+        for outdir in set(os.path.dirname(fname) for fname in batch):
+            if outdir and not os.path.exists(outdir):
+                log.debug('Creating outdir %s ...', outdir)
+                os.makedirs(outdir)
+
+        # write everything to temporary files first...
+        written = []
+        for fname, (zc, divratio) in batch.items():
+            if provenance_matches(zc.metadata.get('provenance', None), fname, exact=True):
+                log.debug('Skipping write of unchanged %s', fname)
+                continue
+            fd, tmpfname = tempfile.mkstemp(suffix='.tmp', prefix='.' + os.path.basename(fname), dir=os.path.dirname(fname) or None)
+            os.close(fd)
+            try:
+                save_anabat(zc, tmpfname, divratio)
+                os.chmod(tmpfname, _file_mode(fname))  # `mkstemp()` creates files private to us
+                written.append((tmpfname, fname))
+            except Exception:
+                log.exception('Failed writing %s', fname)
+                os.remove(tmpfname)
+
+        # ...then make them durable, and only then move them into place
+        for tmpfname, _ in written:
+            with open(tmpfname, 'rb+') as f:
+                os.fsync(f.fileno())
+        for tmpfname, fname in written:
+            if os.name == 'nt' and os.path.exists(fname):
+                os.remove(fname)  # Windows won't rename over an existing file
+            os.rename(tmpfname, fname)
+        if os.name != 'nt':
+            for outdir in set(os.path.dirname(fname) for _, fname in written):
+                fd = os.open(outdir or '.', os.O_RDONLY)
+                try:
+                    os.fsync(fd)  # persist the renames themselves
+                finally:
+                    os.close(fd)
+        log.debug('Wrote %d of %d queued files', len(written), len(batch))
+
+
+def _file_mode(fname):
+    """Permissions for writing `fname`: those of the existing file, else the default per our umask"""
+    try:
+        return stat.S_IMODE(os.stat(fname).st_mode)
+    except OSError:
+        umask = os.umask(0)
+        os.umask(umask)
+        return 0o666 & ~umask
+
+
+def save_anabat(zc, fname, divratio):
+    """Write a ZeroCross signal to an Anabat-format file, creating its directory if necessary"""
+    md = zc.metadata
+    timestamp = md.get('timestamp', None)
+    species = md.get('species', '')
+    note1 = md.get('note1', '')
+    if note1:
+        note2 = 'Myotisoft ZCANT'
+    else:
+        note1, note2 = 'Myotisoft ZCANT', ''
+    provenance = md.get('provenance', None)
+    if zc.supports_amplitude or provenance:
+        log.debug('Adding GUANO metadata :-)')
+        guano = GuanoFile()
+        for field, value in (provenance or {}).items():
+            guano['ZCANT|' + field] = value
+        if zc.supports_amplitude:
+            guano['ZCANT|Amplitudes'] = zc.amplitudes
+    else:
+        log.debug('Not adding GUANO metadata :-(')
+        guano = None
+
+    log.debug('Saving %s ...', fname)
+
+    outdir = os.path.dirname(fname)
+    if outdir and not os.path.exists(outdir):
+        log.debug('Creating outdir %s ...', outdir)
+        os.makedirs(outdir)
+
+    with AnabatFileWriter(fname) as out:
+        out.write_header(timestamp, divratio, species=species, note1=note1, note2=note2, guano=guano)
+        out.write_intervals(zc.to_intervals_us(), zc.status)
@@ -23,7 +23,11 @@ import numpy as np
 
 from zcant import __version__, print_timing
 from zcant.audio import AudioThread, beep
-from zcant.core import MainThread, AnabatFileWriteThread
+from zcant.anabat import DotStatus
+from zcant.core import ZeroCross, Loader, Prefetcher, AnabatWriteQueue, CONVERTED_DIR
+from zcant.workers import ProcessLoader, ProcessPrefetcher, ProcessTimelineLoader
+from zcant.cache import ZeroCrossCache, DiskCache
+from zcant.timeline import NightTimeline, TimelineLoader
 from zcant.system import launch_external, browse_external
 from zcant.plot import ZeroCrossPlotPanel
 from zcant.wx_custom import HpfToolbarSpinner, ThresholdToolbarSlider, EVT_FLOATSPIN
@@ -59,7 +63,10 @@ class ZcantMainFrame(wx.Frame, wx.FileDropTarget):
     FREQ_MINS = [5, 10, 15, 20]           # kHz
     FREQ_MAXS = [80, 100, 125, 150, 200]  # kHz
 
-    def __init__(self, parent, title='Myotisoft ZCANT '+__version__):
+    def __init__(self, parent, title='Myotisoft ZCANT '+__version__, workers=None):
+        """
+        :param workers: optional `ConversionPool`, to convert files outside of the GUI process
+        """
         wx.Frame.__init__(self, parent, title=title, size=(640,480))
 
         # Application State - set initial defaults, then read state from conf file
@@ -81,10 +88,27 @@ class ZcantMainFrame(wx.Frame, wx.FileDropTarget):
         self.wav_interpolation = True
         self.autosave = False
 
+        self.prefetch_next = 3  # count of following files to convert in the background
+        self.prefetch_prev = 1  # count of preceding files to convert in the background
+
         self.window_secs = None
         self.window_start = 0.0
 
-        self.main_thread = None
+        self.cache = ZeroCrossCache(disk=DiskCache())
+        self.writer = AnabatWriteQueue()
+        self.ungated = None  # current .WAV's signal before its noise gate, see `regate()`
+        self.regate_pending = False
+        self.partial = None  # (generation, converted chunks, fraction complete) of the file being converted
+        self.partial_pending = False
+        self.loader = WxProcessLoader(self.after_load, workers, self.cache, preview=True, progress_cb=self.after_progress) if workers \
+            else WxLoader(self.after_load, self.cache, preview=True, progress_cb=self.after_progress)
+        self.prefetcher = ProcessPrefetcher(workers, self.cache, self.loader) if workers \
+            else Prefetcher(self.cache, self.loader)
+        self.timeline = None  # `NightTimeline` of the current directory, while viewing the whole night
+        self.timeline_pending = False
+        self.timeline_loader = WxProcessTimelineLoader(self.after_timeline_segment, workers, self.loader) if workers \
+            else WxTimelineLoader(self.after_timeline_segment, self.loader)
+        self.is_loading = False
         self.audio_thread = None
 
         self.read_conf()
@@ -113,6 +137,8 @@ class ZcantMainFrame(wx.Frame, wx.FileDropTarget):
 
         self.init_keybindings()
 
+        self.Bind(wx.EVT_CLOSE, self.on_close)
+
         # configure drag-and-drop
         wx.FileDropTarget.__init__(self)
         self.SetDropTarget(self)
@@ -149,6 +175,8 @@ class ZcantMainFrame(wx.Frame, wx.FileDropTarget):
         self.Bind(wx.EVT_MENU, self.on_zoom_out, zoom_out_item)
         zoom_whole_item = view_menu.Append(wx.ID_ANY, 'Whole File\t0', ' Zoom display out to show the entire file')
         self.Bind(wx.EVT_MENU, self.on_zoom_off, zoom_whole_item)
+        night_item = view_menu.Append(wx.ID_ANY, 'Whole Night\tN', ' View every file in this directory on a single time axis')
+        self.Bind(wx.EVT_MENU, self.on_view_night, night_item)
 
         view_menu.AppendSeparator()
         compressed_item = view_menu.AppendRadioItem(wx.ID_ANY, 'Compressed View\tSpace', ' View file in compressed (dot-per-pixel) mode')
@@ -291,6 +319,7 @@ class ZcantMainFrame(wx.Frame, wx.FileDropTarget):
 
         self.threshold_slider = ThresholdToolbarSlider(tool_bar, self.wav_threshold, self.WAV_THRESHOLD_DELTA)
         self.Bind(wx.EVT_SCROLL_THUMBRELEASE, self.on_threshold_slider, self.threshold_slider)
+        self.Bind(wx.EVT_SCROLL_THUMBTRACK, self.on_threshold_track, self.threshold_slider)
 
         self.hpf_spinner = HpfToolbarSpinner(tool_bar, self.hpfilter, self.HPF_DELTA)
         self.Bind(EVT_FLOATSPIN, self.on_hpfilter_spinner, self.hpf_spinner)
@@ -389,7 +418,7 @@ class ZcantMainFrame(wx.Frame, wx.FileDropTarget):
         self.autosave = not self.autosave
 
     def get_zc_outdir(self):
-        return os.path.join(self.dirname, '_ZCANT_Converted')
+        return os.path.join(self.dirname, CONVERTED_DIR)
 
     def get_zc_outfname(self):
         return self.filename[:-4]+'.zc'
@@ -414,13 +443,17 @@ class ZcantMainFrame(wx.Frame, wx.FileDropTarget):
     @print_timing
     def on_save_file(self, event):
         # For now, we will only save a converted .WAV as Anabat file
-        if not self.filename.lower().endswith('.wav'):
+        if self.timeline is not None or not self.filename.lower().endswith('.wav'):
             return
+        if self.zc.metadata.get('preview', False):
+            return  # never save an approximation; we'll save upon full conversion
         outfile = self.get_zc_outfpath()
-        AnabatFileWriteThread(self.zc, outfile, self.wav_divratio)
+        self.writer.save(self.zc, outfile, self.wav_divratio)
 
     def on_file_delete(self, event):
         log.debug('Delete file')
+        if self.timeline is not None:
+            return  # no single current file
         currentfile = os.path.join(self.dirname, self.filename)
         if not os.path.exists(currentfile):
             return  # we've deleted ourselves into a hole
@@ -433,7 +466,10 @@ class ZcantMainFrame(wx.Frame, wx.FileDropTarget):
 
     def on_zc_file_delete(self, event):
         log.debug('Delete ZC file')
+        if self.timeline is not None:
+            return  # no single current file
         zcfile = self.get_zc_outfpath()
+        self.writer.discard(zcfile)
         if not os.path.exists(zcfile):
             return
         dest = self.ensure_delete_outdir()
@@ -451,7 +487,7 @@ class ZcantMainFrame(wx.Frame, wx.FileDropTarget):
         if self.audio_thread is not None and self.audio_thread.is_playing():
             self.audio_thread.stop()
         else:
-            if not self.filename.lower().endswith('.wav'):
+            if self.timeline is not None or not self.filename.lower().endswith('.wav'):
                 return
             filename = os.path.join(self.dirname, self.filename)
             if self.window_secs:
@@ -482,6 +518,10 @@ class ZcantMainFrame(wx.Frame, wx.FileDropTarget):
         log.debug('exit: %s', event)
         self.Close(True)
 
+    def on_close(self, event):
+        self.writer.flush()  # don't lose any queued saves
+        event.Skip()
+
     def on_open(self, event):
         log.debug('open: %s', event)
         dlg = wx.FileDialog(self, 'Choose a file', self.dirname, '', 'Anabat files|*.*|Anabat files|*.zc|Wave files|*.wav', wx.OPEN)
@@ -527,6 +567,11 @@ class ZcantMainFrame(wx.Frame, wx.FileDropTarget):
             'freq_min':   self.freq_min,
             'freq_max':   self.freq_max,
             'autosave':   self.autosave,
+            'cache_mb':   self.cache.max_bytes // (1024*1024),
+            'disk_cache_mb': self.cache.disk.max_bytes // (1024*1024),
+            'prefetch_next': self.prefetch_next,
+            'prefetch_prev': self.prefetch_prev,
+            'prefetch_mb': self.prefetcher.max_bytes // (1024*1024),
         }
         with open(CONF_FNAME, 'w') as outf:
             logging.debug('Writing conf file: %s', CONF_FNAME)
@@ -547,6 +592,11 @@ class ZcantMainFrame(wx.Frame, wx.FileDropTarget):
             self.wav_interpolation = conf.get('interpolation', True)
             self.freq_min = conf.get('freq_min', 15)
             self.freq_max = conf.get('freq_max', 100)
+            self.cache.max_bytes = conf.get('cache_mb', 256) * 1024*1024
+            self.cache.disk.max_bytes = conf.get('disk_cache_mb', 2048) * 1024*1024
+            self.prefetch_next = conf.get('prefetch_next', 3)
+            self.prefetch_prev = conf.get('prefetch_prev', 1)
+            self.prefetcher.max_bytes = conf.get('prefetch_mb', 64) * 1024*1024
             #self.autosave = conf.get('autosave', False)  # TODO: for now, we choose to always start with autosave off
             harmonics = conf.get('harmonics', {'0.5': False, '1': True, '2': False, '3': False})
 
@@ -626,6 +676,8 @@ class ZcantMainFrame(wx.Frame, wx.FileDropTarget):
             return  # max zoom is 1/256 sec (4 ms)
 
         if self.window_secs is None:
+            if self.zc.duration <= 0:
+                return  # nothing (yet) to zoom in on
             self.window_secs = largest_power_of_two(self.zc.duration)
         else:
             self.window_secs /= 2
@@ -683,6 +735,8 @@ class ZcantMainFrame(wx.Frame, wx.FileDropTarget):
 
     def reload_file(self):
         """Re-plot current file without reloading from disk"""
+        if self.timeline is not None:
+            return self.plot_timeline()
         return self.plot(self.zc)
 
     def load_file(self, dirname, filename):
@@ -690,6 +744,12 @@ class ZcantMainFrame(wx.Frame, wx.FileDropTarget):
         changes that necessitate re-parsing the original file itself."""
         log.debug('\n\nload_file:  %s  %s', dirname, filename)
 
+        if self.timeline is not None:
+            # leaving the whole-night view
+            self.timeline = None
+            self.timeline_loader.cancel()
+            self.window_start = 0.0
+
         if filename != self.filename:
             # reset some file-specific state
             self.window_start = 0.0
@@ -704,18 +764,84 @@ class ZcantMainFrame(wx.Frame, wx.FileDropTarget):
         if not path:
             return
 
-        kwargs = dict(hpfilter_khz=self.hpfilter,
-                      divratio=self.wav_divratio,
-                      threshold_factor=self.wav_threshold,
-                      interpolation=self.wav_interpolation)
-
-        wx.BeginBusyCursor()
-        WxMainThread(self.after_load, path, **kwargs)
-
-    def after_load(self, result):
-        # callback when we return from asynchronous MainThread
-        log.debug('after_load: %s', result)
+        if not self.is_loading:
+            wx.BeginBusyCursor()
+            self.is_loading = True
+        self.loader.request(path, **self.conversion_kwargs())
+        self.prefetch_neighbors(dirname, filename)
+
+    def conversion_kwargs(self):
+        """Current conversion parameters, as for `load_zerocross()`"""
+        return dict(hpfilter_khz=self.hpfilter,
+                    divratio=self.wav_divratio,
+                    threshold_factor=0.0,  # we apply the noise gate ourselves, see `regate()`
+                    interpolation=self.wav_interpolation)
+
+    def prefetch_neighbors(self, dirname, filename):
+        """Convert the files around `filename` in the background, those after it first"""
+        try:
+            files = self.listdir(dirname)
+        except OSError:
+            return self.prefetcher.cancel()
+        i = files.index(filename) if filename in files else bisect(files, filename)
+        j = i + 1 if filename in files else i
+        neighbors = files[j:j+self.prefetch_next] + files[max(i-self.prefetch_prev, 0):i][::-1]
+        self.prefetcher.prefetch([os.path.join(dirname, fname) for fname in neighbors], **self.conversion_kwargs())
+
+    def on_view_night(self, event):
+        """View every file in the current directory on a single time axis"""
+        if not self.dirname:
+            return
+        try:
+            files = self.listdir(self.dirname)
+        except OSError:
+            return
+        if self.timeline is None:
+            self.window_secs, self.window_start = None, 0.0
+        self.loader.cancel()
+        self.prefetcher.cancel()
+        if self.is_loading:
+            self.is_loading = False
+            wx.EndBusyCursor()
+        self.ungated = self.partial = None
+        self.timeline = NightTimeline([os.path.join(self.dirname, fname) for fname in files],
+                                      cache=self.cache, gate=self.wav_threshold, **self.conversion_kwargs())
+        self.plot_timeline()
+
+    def after_timeline_segment(self, timeline, i):
+        # callback when a segment of the whole-night timeline has been converted in the background
+        if timeline is not self.timeline or self.timeline_pending:
+            return
+        # coalesce segments which arrive faster than we can plot them
+        self.timeline_pending = True
+        wx.CallAfter(self.plot_timeline)
+
+    def plot_timeline(self):
+        """Plot what we have of the whole-night timeline, converting what's missing in the background"""
+        self.timeline_pending = False
+        if self.timeline is None:
+            return
+        if self.window_secs is None:
+            zc = self.timeline.windowed(0.0, self.timeline.duration, convert=False)
+            self.zc = zc  # zooming and panning are relative to the whole night
+        else:
+            zc = self.timeline.windowed(self.window_start, self.window_secs, convert=False)
+        self.timeline_loader.request(self.timeline, zc.metadata['pending'])
+        self.plot(zc)
+
+    def after_load(self, generation, result):
+        # callback when we return from asynchronous Loader
+        log.debug('after_load: %s  %r', result, self.cache)
+        if not self.loader.is_current(generation):
+            return  # superseded while this result was on its way to us; a newer one will arrive
+        preview = result is not None and result.metadata.get('preview', False)
+        if not preview:
+            self.partial = None
         if result is not None:
+            result = result.without_status(DotStatus.OFF)  # off-dots are never displayed
+            self.ungated = result if result.metadata['path'].lower().endswith('.wav') else None
+            if self.ungated is not None:
+                result = result.gated(self.wav_threshold)
             self.plot(result)
 
             # only set state upon success
@@ -723,11 +849,46 @@ class ZcantMainFrame(wx.Frame, wx.FileDropTarget):
             self.dirname = os.path.dirname(result.metadata['path'])
             self.zc = result
 
-            if self.autosave:
+            if self.autosave and not preview:
                 self.on_save_file(None)
 
+        if preview:
+            return  # the full conversion follows, and will replace it
+        self.is_loading = False
         wx.EndBusyCursor()
 
+    def after_progress(self, generation, zc, fraction):
+        # callback with each converted chunk of a .WAV file from asynchronous Loader
+        if not self.loader.is_current(generation):
+            return
+        if self.partial is None or self.partial[0] != generation:
+            self.partial = generation, [], 0.0
+        self.partial = generation, self.partial[1] + [zc], fraction
+        self.statusbar.SetStatusText('Converting %s:  %d%%' % (zc.metadata['filename'], fraction * 100))
+        if not self.partial_pending:
+            # coalesce chunks which arrive faster than we can plot them
+            self.partial_pending = True
+            wx.CallAfter(self.plot_partial, generation)
+
+    def plot_partial(self, generation):
+        """Plot the chunks converted so far, followed by the rest of the preview if we have one"""
+        self.partial_pending = False
+        if self.partial is None or self.partial[0] != generation or not self.loader.is_current(generation):
+            return  # already complete, or superseded
+        _, chunks, fraction = self.partial
+        times = np.concatenate([chunk.times for chunk in chunks])
+        freqs = np.concatenate([chunk.freqs for chunk in chunks])
+        amplitudes = np.concatenate([chunk.amplitudes for chunk in chunks])
+        metadata = dict(chunks[0].metadata)
+        preview = self.ungated
+        if preview is not None and preview.metadata.get('preview', False) and preview.metadata['path'] == metadata['path']:
+            rest = preview[preview.times > times[-1]] if len(times) else preview
+            times, freqs = np.append(times, rest.times), np.append(freqs, rest.freqs)
+            amplitudes = np.append(amplitudes, rest.amplitudes)
+            metadata = preview.metadata
+        self.plot(ZeroCross(times, freqs, amplitudes, metadata).gated(self.wav_threshold))
+        self.statusbar.SetStatusText('Converting %s:  %d%%' % (metadata['filename'], fraction * 100))
+
     def plot(self, zc):
         title = title_from_path(zc.metadata.get('path', ''))
         conf = dict(compressed=self.is_compressed, colormap=self.cmap,
@@ -737,7 +898,7 @@ class ZcantMainFrame(wx.Frame, wx.FileDropTarget):
                     smooth_slopes=self.use_smoothed_slopes, display_cursor=self.display_cursor,
                     pulse_markers=self.display_pulse_markers)
 
-        if self.window_secs is not None:
+        if self.window_secs is not None and self.timeline is None:  # the timeline windows for us
             zc = zc.windowed(self.window_start, self.window_secs)
 
         try:
@@ -755,7 +916,7 @@ class ZcantMainFrame(wx.Frame, wx.FileDropTarget):
 
     def _pretty_window_size(self):
         if self.window_secs is None:
-            return 'whole file'
+            return 'whole night' if self.timeline is not None else 'whole file'
         elif self.window_secs >= 1.0:
             return str(self.window_secs) + ' secs'
         else:
@@ -845,7 +1006,7 @@ class ZcantMainFrame(wx.Frame, wx.FileDropTarget):
         self.wav_threshold += self.WAV_THRESHOLD_DELTA
         self.threshold_slider.set_threshold(self.wav_threshold)
         log.debug('increasing threshold to %.2f RMS', self.wav_threshold)
-        self.load_file(self.dirname, self.filename)
+        self.regate()
         self.save_conf()
 
     def on_threshold_down(self, event):
@@ -854,15 +1015,34 @@ class ZcantMainFrame(wx.Frame, wx.FileDropTarget):
         self.wav_threshold -= self.WAV_THRESHOLD_DELTA
         self.threshold_slider.set_threshold(self.wav_threshold)
         log.debug('decreasing threshold to %.2f RMS', self.wav_threshold)
-        self.load_file(self.dirname, self.filename)
+        self.regate()
         self.save_conf()
 
     def on_threshold_slider(self, event):
         self.wav_threshold = event.GetEventObject().GetValue() * self.WAV_THRESHOLD_DELTA
         log.debug('slider threshold to %.2f RMS', self.wav_threshold)
-        self.load_file(self.dirname, self.filename)
+        self.regate()
         self.save_conf()
 
+    def on_threshold_track(self, event):
+        self.wav_threshold = event.GetEventObject().GetValue() * self.WAV_THRESHOLD_DELTA
+        if not self.regate_pending:
+            # coalesce a burst of drag events into a single re-plot
+            self.regate_pending = True
+            wx.CallAfter(self.regate, live=True)
+
+    def regate(self, live=False):
+        """Re-apply the noise gate at the current threshold, without reconverting"""
+        self.regate_pending = False
+        if self.timeline is not None and not live:
+            return self.on_view_night(None)  # each segment is gated as it's converted
+        if self.ungated is None:
+            return  # only .WAV files are noise-gated
+        self.zc = self.ungated.gated(self.wav_threshold)
+        self.reload_file()
+        if self.autosave and not live:
+            self.on_save_file(None)
+
     def on_hpfilter_up(self, event):
         self.hpfilter += self.HPF_DELTA
         log.debug('increasing high-pass filter to %.1f kHz', self.hpfilter)
@@ -886,8 +1066,28 @@ class ZcantMainFrame(wx.Frame, wx.FileDropTarget):
         self.save_conf()
 
 
-class WxMainThread(MainThread):
-    """Main thread handler which hooks back into wx GUI thread upon completion"""
+class WxLoader(Loader):
+    """Loader which hooks back into wx GUI thread upon completion"""
+
+    def on_complete(self, generation, result):
+        wx.CallAfter(self.parent_cb, generation, result)
+
+    def on_progress(self, generation, zc, fraction):
+        wx.CallAfter(self.progress_cb, generation, zc, fraction)
+
+
+class WxTimelineLoader(TimelineLoader):
+    """TimelineLoader which hooks back into wx GUI thread upon each converted segment"""
+
+    def on_segment(self, timeline, i):
+        wx.CallAfter(self.segment_cb, timeline, i)
+
+
+class WxProcessLoader(ProcessLoader, WxLoader):
+    """Out-of-process loader which hooks back into wx GUI thread upon completion"""
+    pass
+
 
-    def on_complete(self, result):
-        wx.CallAfter(self.parent_cb, result)
+class WxProcessTimelineLoader(ProcessTimelineLoader, WxTimelineLoader):
+    """Out-of-process timeline loader which hooks back into wx GUI thread upon each converted segment"""
+    pass
@@ -110,6 +110,8 @@ class ZeroCrossPlotPanel(PlotPanel):
         'filter_markers': (20.0,), # filter lines kHz
         'compressed': False,       # compressed view (True) or realtime (False)
         'smooth_slopes': True,     # smooth out noisy slope values
+        'smooth_window': 3,        # slope smoothing window size, in dots
+        'aggregate': True,         # draw per-pixel min/max frequency lines rather than dots when zoomed out
         'interpolate': True,       # interpolate between WAV samples
         'pulse_markers': True,     # display pulse separators in compressed view
         'display_cursor': False,   # display horiz and vert cursor lines
@@ -120,11 +122,11 @@ class ZeroCrossPlotPanel(PlotPanel):
 
     def __init__(self, parent, zc, config=None, **kwargs):
         self.zc = zc
-        self.times = zc.times if zc else np.array([0.0])
-        self.freqs = zc.freqs if zc else np.array([0.0])
+        self.times = zc.times
+        self.freqs = zc.freqs
         dot_max, dot_default, dot_min = self.config['dot_sizes']
-        if zc.supports_amplitude:
-            self.amplitudes = zc.amplitudes if zc else np.array([0.0])
+        if zc.supports_amplitude and zc:
+            self.amplitudes = zc.amplitudes
             # normalize amplitude values to display point size
             log.debug(' orig. amp  max: %.1f  min: %.1f', np.max(self.amplitudes), np.min(self.amplitudes))
             self.scaled_amplitudes = (zc.amplitudes / np.amax(self.amplitudes)) * (dot_max - dot_min) + dot_min
@@ -137,7 +139,7 @@ class ZeroCrossPlotPanel(PlotPanel):
         if config:
             self.config.update(config)
 
-        self.slopes = zc.get_slopes(smooth=self.config['smooth_slopes'])
+        self.slopes = zc.get_slopes(smooth=self.config['smooth_slopes'], window=self.config['smooth_window'])
         self.freqs = self.freqs / 1000  # convert Hz to KHz  (the /= operator doesn't work here?!)
 
         PlotPanel.__init__(self, parent, **kwargs)
@@ -154,6 +156,7 @@ class ZeroCrossPlotPanel(PlotPanel):
         self.dot_plot = dot_plot = self.figure.add_subplot(gs[0])
 
         miny, maxy = self.config['freqminmax']
+        dot_max = self.config['dot_sizes'][0]
         plot_kwargs = dict(cmap=self.config['colormap'],
                            vmin=self.SLOPE_MIN, vmax=self.SLOPE_MAX,  # vmin/vmax define where we scale our colormap
                            c=self.slopes, s=self.scaled_amplitudes,   # dot color and size
@@ -174,9 +177,30 @@ class ZeroCrossPlotPanel(PlotPanel):
 
         elif not self.config['compressed']:
             # Realtime View
-            plot_harmonics(self.times)
-            dot_scatter = dot_plot.scatter(self.times, self.freqs, **plot_kwargs)
-            dot_plot.set_xlim(self.times[0], self.times[-1])
+            xlim = self.zc.window or (self.times[0], self.times[-1])
+            level = None
+            pixels = self.GetSize()[0] * 0.85  # approximate width of the dot plot
+            if self.config['aggregate'] and len(self.zc) > pixels:
+                pyramid = self.zc.get_pyramid(smooth=self.config['smooth_slopes'], window=self.config['smooth_window'])
+                level = pyramid.level_for(xlim[1] - xlim[0], pixels)
+
+            if level is not None:
+                # many dots per pixel, so draw one min/max frequency line per pixel-sized bin instead
+                x, bins = pyramid.window(level, *xlim)
+                dot_min = self.config['dot_sizes'][2]
+                amp_max = np.amax(bins['amplitude']) if len(bins) else 1.0
+                line_kwargs = dict(cmap=self.config['colormap'], norm=Normalize(vmin=self.SLOPE_MIN, vmax=self.SLOPE_MAX),
+                                   linewidths=np.sqrt(bins['amplitude'] / amp_max * (dot_max - dot_min) + dot_min))
+                fmin, fmax = bins['fmin'] / 1000, bins['fmax'] / 1000
+                for harmonic, factor in (('0.5', 0.5), ('2', 2), ('3', 3)):
+                    if self.config['harmonics'][harmonic]:
+                        dot_plot.vlines(x, fmin*factor, fmax*factor, alpha=0.2, **line_kwargs).set_array(bins['slope'])
+                dot_scatter = dot_plot.vlines(x, fmin, fmax, **line_kwargs)
+                dot_scatter.set_array(bins['slope'])
+            else:
+                plot_harmonics(self.times)
+                dot_scatter = dot_plot.scatter(self.times, self.freqs, **plot_kwargs)
+            dot_plot.set_xlim(*xlim)
             dot_plot.set_xlabel('Time (sec)')
 
         else:
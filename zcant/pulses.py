@@ -0,0 +1,153 @@
+"""
+Pulse segmentation and per-pulse call parameters.
+
+A zero-cross signal is split into pulses wherever there's a silence gap, an abrupt frequency
+jump, or an out-of-range dot; pulses with too few dots are discarded as noise. Each pulse is
+summarized as one record of a structured NumPy array (see `PULSE_DTYPE`):
+
+    table = extract_pulses(zc)
+    table = extract_pulses_batch([zc1, zc2, ...])  # `sequence` field identifies the source
+    table[table['fc'] > 40000]['duration']
+
+Everything, including the batch case, is computed with whole-array operations; there are no
+per-pulse (or per-sequence) Python loops beyond gathering the input arrays.
+
+---------------
+Myotisoft ZCANT
+Copyright (C) 2012-2017 Myotisoft LLC, all rights reserved.
+You may use, distribute, and modify this code under the terms of the MIT License.
+"""
+
+import numpy as np
+
+from zcant import print_timing
+
+import logging
+log = logging.getLogger(__name__)
+
+
+__all__ = 'PULSE_DTYPE', 'extract_pulses', 'extract_pulses_batch'
+
+
+PULSE_DTYPE = np.dtype([
+    ('sequence',   '<i4'),  # index of the source signal within a batch
+    ('first',      '<i8'),  # index of the pulse's first dot within its source signal
+    ('last',       '<i8'),  # index of the pulse's last dot (inclusive)
+    ('dots',       '<i4'),  # dot count
+    ('start',      '<f8'),  # start time, seconds
+    ('end',        '<f8'),  # end time, seconds
+    ('duration',   '<f4'),  # seconds
+    ('fmax',       '<f4'),  # maximum frequency, Hz
+    ('fmin',       '<f4'),  # minimum frequency, Hz
+    ('fc',         '<f4'),  # characteristic frequency, Hz
+    ('fknee',      '<f4'),  # knee frequency, Hz
+    ('slope_mean', '<f4'),  # mean slope, octaves per second
+    ('slope_max',  '<f4'),  # maximum slope, octaves per second
+])
+
+TIME_GAP = 0.01       # seconds of silence which separates two pulses
+MAX_FREQ_JUMP = 0.3   # frequency change (octaves) between adjacent dots which separates two pulses
+MIN_DOTS = 5          # minimum dots in a pulse
+FC_PORTION = 0.4      # Fc is sought only within this final portion of the pulse
+
+
+def extract_pulses(zc, time_gap=TIME_GAP, max_freq_jump=MAX_FREQ_JUMP, min_dots=MIN_DOTS):
+    """Segment a single `ZeroCross` into pulses, producing a `PULSE_DTYPE` table"""
+    return _pulse_table(zc.times, zc.freqs, None, None, time_gap, max_freq_jump, min_dots)
+
+
+@print_timing
+def extract_pulses_batch(zcs, time_gap=TIME_GAP, max_freq_jump=MAX_FREQ_JUMP, min_dots=MIN_DOTS):
+    """Segment many `ZeroCross` signals into pulses at once, producing a single `PULSE_DTYPE` table.
+
+    The `sequence` field of each record is the index of its signal within `zcs`.
+    """
+    zcs = list(zcs)
+    lengths = np.array([len(zc) for zc in zcs], dtype=np.intp)
+    if not lengths.sum():
+        return np.zeros(0, dtype=PULSE_DTYPE)
+    times = np.concatenate([zc.times for zc in zcs])
+    freqs = np.concatenate([zc.freqs for zc in zcs])
+    sequence = np.repeat(np.arange(len(zcs), dtype=np.int32), lengths)
+    offsets = np.cumsum(lengths) - lengths
+    return _pulse_table(times, freqs, sequence, offsets, time_gap, max_freq_jump, min_dots)
+
+
+def _segmented_argmin(values, starts):
+    """Index of the minimum value within each contiguous segment beginning at `starts`"""
+    segment = np.repeat(np.arange(len(starts)), np.diff(np.append(starts, len(values))))
+    order = np.lexsort((values, segment))  # sorted by segment, then by value
+    return order[starts]
+
+
+def _pulse_table(times, freqs, sequence, offsets, time_gap, max_freq_jump, min_dots):
+    """Segment the (possibly concatenated) dot arrays into pulses and summarize each of them"""
+    min_dots = max(min_dots, 2)
+    dots = np.flatnonzero(freqs > 0)  # out-of-range dots never belong to a pulse
+    if len(dots) < min_dots:
+        return np.zeros(0, dtype=PULSE_DTYPE)
+    t = np.asarray(times, dtype=np.float64)[dots]
+    f = np.asarray(freqs, dtype=np.float64)[dots]
+    octaves = np.log2(f)
+
+    # a break between dot k and k+1 ends one pulse and starts the next
+    dt, doct = np.diff(t), np.diff(octaves)
+    breaks = (dt > time_gap) | (np.abs(doct) > max_freq_jump) | (np.diff(dots) != 1)
+    if sequence is not None:
+        breaks |= np.diff(sequence[dots]) != 0
+
+    starts = np.append(0, np.flatnonzero(breaks) + 1)
+    counts = np.diff(np.append(starts, len(dots)))
+    keep = counts >= min_dots
+    if not keep.any():
+        return np.zeros(0, dtype=PULSE_DTYPE)
+
+    # drop short pulses and re-pack, so every remaining dot belongs to a kept pulse
+    member = np.repeat(keep, counts)
+    dots, t, f, octaves = dots[member], t[member], f[member], octaves[member]
+    counts = counts[keep]
+    starts = np.cumsum(counts) - counts
+    ends = starts + counts - 1
+    segment = np.repeat(np.arange(len(counts)), counts)
+    position = np.arange(len(dots)) - starts[segment]  # dot position within its pulse
+
+    # slope of each adjacent pair within a pulse, attributed to the pair's first dot (0 for a pulse's last dot)
+    slopes = np.zeros(len(dots))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        pair_slopes = np.abs(np.diff(octaves) / np.diff(t))
+    slopes[:-1] = np.where(np.isfinite(pair_slopes), pair_slopes, 0.0)
+    slopes[ends] = 0.0
+
+    table = np.zeros(len(counts), dtype=PULSE_DTYPE)
+    table['dots'] = counts
+    table['first'] = dots[starts]
+    table['last'] = dots[ends]
+    if sequence is not None:
+        table['sequence'] = sequence[dots[starts]]
+        table['first'] -= offsets[table['sequence']]
+        table['last'] -= offsets[table['sequence']]
+    table['start'] = t[starts]
+    table['end'] = t[ends]
+    table['duration'] = t[ends] - t[starts]
+    table['fmax'] = np.maximum.reduceat(f, starts)
+    table['fmin'] = np.minimum.reduceat(f, starts)
+    table['slope_mean'] = np.add.reduceat(slopes, starts) / (counts - 1)
+    table['slope_max'] = np.maximum.reduceat(slopes, starts)
+
+    # Fc: frequency at the end of the flattest pair within the final portion of the pulse
+    tail = (position >= np.floor((1.0 - FC_PORTION) * (counts - 1))[segment]) & (position < (counts - 1)[segment])
+    flattest = _segmented_argmin(np.where(tail, slopes, np.inf), starts)
+    table['fc'] = f[np.minimum(flattest + 1, ends)]
+
+    # knee: the dot furthest from the straight line joining the pulse's first and last dots,
+    # with both time and frequency normalized to the pulse's own extent
+    extent_t = np.maximum(t[ends] - t[starts], 1e-9)[segment]
+    oct_min, oct_max = np.minimum.reduceat(octaves, starts), np.maximum.reduceat(octaves, starts)
+    extent_oct = np.maximum(oct_max - oct_min, 1e-9)[segment]
+    u = (t - t[starts][segment]) / extent_t
+    w = (octaves - oct_min[segment]) / extent_oct
+    w0, w1 = w[starts][segment], w[ends][segment]
+    knee = _segmented_argmin(-np.abs(w - (w0 + (w1 - w0) * u)), starts)
+    table['fknee'] = f[knee]
+
+    return table
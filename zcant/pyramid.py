@@ -0,0 +1,123 @@
+"""
+Multi-resolution aggregation of zero-cross dots, for fast display when zoomed out.
+
+Dots are grouped into time bins, and each level of the pyramid doubles the bin width of the level
+below it. Each bin records the min and max frequency, mean slope, and max amplitude of its dots, so
+a plot which is many dots per pixel wide may draw one vertical line per bin instead of scattering
+every dot. Levels are built only as they're requested, each from the level below.
+
+---------------
+Myotisoft ZCANT
+Copyright (C) 2012-2017 Myotisoft LLC, all rights reserved.
+You may use, distribute, and modify this code under the terms of the MIT License.
+"""
+
+import math
+
+import numpy as np
+
+from zcant import print_timing
+
+import logging
+log = logging.getLogger(__name__)
+
+
+__all__ = 'ZeroCrossPyramid', 'LEVEL_DTYPE'
+
+
+LEVEL_DTYPE = np.dtype([
+    ('bin',       '<i8'),  # bin number, ie. start time / bin width
+    ('fmin',      '<f4'),  # Hz
+    ('fmax',      '<f4'),  # Hz
+    ('slope',     '<f4'),  # mean slope, octaves per second
+    ('amplitude', '<f4'),  # max amplitude
+    ('dots',      '<i4'),  # dot count
+])
+
+
+class ZeroCrossPyramid(object):
+    """Lazily-built pyramid of time-binned dot aggregates. Only dots with a frequency are included.
+
+    Level 0 bins are `base_bin` seconds wide, and level k bins are `base_bin * 2**k` seconds wide.
+    Bins without any dots are omitted.
+    """
+
+    BASE_BIN = 2.0 ** -14  # seconds (about 61 microseconds)
+    MAX_LEVEL = 24         # bins of about 17 minutes
+
+    def __init__(self, times, freqs, slopes, amplitudes=None, base_bin=BASE_BIN):
+        self.base_bin = base_bin
+        self._dots = times, freqs, slopes, amplitudes
+        self._levels = {}
+
+    def __repr__(self):
+        return '%s(levels=%s)' % (self.__class__.__name__, sorted(self._levels))
+
+    @property
+    def nbytes(self):
+        """Memory used by the levels built so far"""
+        return sum(level.nbytes for level in self._levels.values())
+
+    def bin_width(self, k):
+        return self.base_bin * 2 ** k
+
+    def level(self, k):
+        """Produce the `LEVEL_DTYPE` array of level k, building it (and any levels below) as needed"""
+        if k not in self._levels:
+            self._levels[k] = self._build_base() if k == 0 else self._merge(self.level(k - 1))
+        return self._levels[k]
+
+    @print_timing
+    def _build_base(self):
+        times, freqs, slopes, amplitudes = self._dots
+        valid = freqs > 0
+        times, freqs, slopes = times[valid], freqs[valid], slopes[valid]
+        amplitudes = amplitudes[valid] if amplitudes is not None else np.ones(len(times))
+        bins = np.floor(times / self.base_bin).astype(np.int64)
+        starts = np.flatnonzero(np.append(True, np.diff(bins) != 0))  # times are sorted, so bins are contiguous
+        level = np.zeros(len(starts), dtype=LEVEL_DTYPE)
+        if not len(starts):
+            return level
+        counts = np.diff(np.append(starts, len(bins)))
+        level['bin'] = bins[starts]
+        level['fmin'] = np.minimum.reduceat(freqs, starts)
+        level['fmax'] = np.maximum.reduceat(freqs, starts)
+        level['slope'] = np.add.reduceat(slopes, starts) / counts
+        level['amplitude'] = np.maximum.reduceat(amplitudes, starts)
+        level['dots'] = counts
+        return level
+
+    def _merge(self, below):
+        """Merge adjacent pairs of bins from the level below"""
+        if not len(below):
+            return below.copy()
+        bins = below['bin'] // 2
+        starts = np.flatnonzero(np.append(True, np.diff(bins) != 0))
+        level = np.zeros(len(starts), dtype=LEVEL_DTYPE)
+        level['bin'] = bins[starts]
+        level['fmin'] = np.minimum.reduceat(below['fmin'], starts)
+        level['fmax'] = np.maximum.reduceat(below['fmax'], starts)
+        level['dots'] = np.add.reduceat(below['dots'], starts)
+        level['slope'] = np.add.reduceat(below['slope'] * below['dots'], starts) / level['dots']
+        level['amplitude'] = np.maximum.reduceat(below['amplitude'], starts)
+        return level
+
+    def level_for(self, duration, pixels):
+        """Choose the coarsest level whose bins are no wider than a pixel, for displaying `duration`
+        seconds across `pixels` pixels. Produces None if even level 0 is too coarse.
+        """
+        if duration <= 0 or pixels <= 0:
+            return None
+        k = int(math.floor(math.log(duration / pixels / self.base_bin, 2)))
+        return min(k, self.MAX_LEVEL) if k >= 0 else None
+
+    def window(self, k, start, end):
+        """Produce (bin center times, bins) for the level k bins within [start, end] seconds.
+        The bins are a slice of the level array, so don't modify them.
+        """
+        level = self.level(k)
+        width = self.bin_width(k)
+        i = np.searchsorted(level['bin'], math.floor(start / width), side='left')
+        j = np.searchsorted(level['bin'], math.floor(end / width), side='right')
+        bins = level[i:j]
+        return (bins['bin'] + 0.5) * width, bins
@@ -0,0 +1,264 @@
+"""
+Nearest-neighbor search for similar pulses across many recordings.
+
+Each pulse (see `zcant.pulses`) is described by a feature vector of its Fmax, Fmin, Fc, duration
+and mean slope, plus its frequency contour resampled to a fixed number of points. Vectors are
+held in a KD-tree, so k-nearest-neighbor queries stay fast across millions of pulses:
+
+    index = SimilarityIndex.load(fname)  # or SimilarityIndex()
+    index.add('M7122036.45#', zc)
+    for distance, name, first, last in index.query_zc(reference_zc, pulse=3, k=20):
+        pass
+    index.save(fname)
+
+Newly added pulses are kept in a small buffer which is searched by brute force, and only merged
+into the tree once the buffer grows large, so adding a file costs little.
+
+Usage:
+    python -m zcant.similarity add INDEX.npz PATH [PATH ...]
+    python -m zcant.similarity query INDEX.npz FILE [--pulse N] [-k K]
+
+---------------
+Myotisoft ZCANT
+Copyright (C) 2012-2017 Myotisoft LLC, all rights reserved.
+You may use, distribute, and modify this code under the terms of the MIT License.
+"""
+
+from __future__ import print_function
+
+import os
+import os.path
+import sys
+import argparse
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+from zcant import print_timing
+from zcant.anabat import extract_anabat_dots
+from zcant.core import ZeroCross
+from zcant.pulses import extract_pulses, extract_pulses_batch
+
+import logging
+log = logging.getLogger(__name__)
+
+
+__all__ = 'SimilarityIndex', 'pulse_features'
+
+
+CONTOUR_POINTS = 16
+SCALAR_FEATURES = 5  # fmax, fmin, fc, duration, slope
+FEATURE_COUNT = SCALAR_FEATURES + CONTOUR_POINTS
+CONTOUR_WEIGHT = np.sqrt(4.0 / CONTOUR_POINTS)  # the whole contour weighs about as much as 4 scalar features
+
+INDEX_VERSION = 1
+
+
+def _text(name):
+    """Produce a name as text, decoding a byte string path with the filesystem encoding"""
+    if not isinstance(name, bytes):
+        return name
+    try:
+        return name.decode(sys.getfilesystemencoding() or 'utf-8')
+    except UnicodeDecodeError:
+        return name.decode('utf-8', 'replace')  # eg. a UTF-8 path under an ASCII locale
+
+
+def pulse_features(zcs, table):
+    """Produce an (N, FEATURE_COUNT) float32 array of feature vectors for the pulses of a table.
+
+    :param zcs: the `ZeroCross` signals which `table` was extracted from (a single signal if
+                `table` came from `extract_pulses()`, else a list)
+    :param table: a `PULSE_DTYPE` pulse table
+    """
+    if isinstance(zcs, ZeroCross):
+        zcs = [zcs]
+    features = np.zeros((len(table), FEATURE_COUNT), dtype=np.float32)
+    if not len(table):
+        return features
+
+    # frequencies in octaves and durations/slopes log-scaled, so distances are roughly proportional
+    features[:, 0] = np.log2(table['fmax'])
+    features[:, 1] = np.log2(table['fmin'])
+    features[:, 2] = np.log2(table['fc'])
+    features[:, 3] = np.log2(np.maximum(table['duration'] * 1000.0, 0.1))
+    features[:, 4] = np.log2(1.0 + table['slope_mean'])
+
+    # contour: log frequency linearly interpolated at evenly spaced (fractional) dot positions
+    lengths = np.array([len(zc) for zc in zcs], dtype=np.intp)
+    log_freqs = np.concatenate([zc.get_log_freqs() for zc in zcs])
+    first = (np.cumsum(lengths) - lengths)[table['sequence']] + table['first']
+    last = first + (table['last'] - table['first'])
+    positions = first[:, np.newaxis] + (last - first)[:, np.newaxis] * np.linspace(0.0, 1.0, CONTOUR_POINTS)
+    lo = np.floor(positions).astype(np.intp)
+    hi = np.minimum(lo + 1, last[:, np.newaxis])
+    frac = positions - lo
+    features[:, SCALAR_FEATURES:] = (log_freqs[lo] * (1.0 - frac) + log_freqs[hi] * frac) * CONTOUR_WEIGHT
+    return features
+
+
+class SimilarityIndex(object):
+    """k-nearest-neighbor index of pulse feature vectors.
+
+    Each indexed pulse is identified by the name of its source file and its dot range there. Names
+    must be unique; the command line uses paths relative to the index's own directory.
+    """
+
+    def __init__(self, rebuild_threshold=4096):
+        self.rebuild_threshold = rebuild_threshold
+        self.names = []           # source names; pulses refer to them by position
+        self._name_ids = {}
+        self.features = np.zeros((0, FEATURE_COUNT), dtype=np.float32)
+        self.source = np.zeros(0, dtype=np.int32)   # name index of each pulse
+        self.dots = np.zeros((0, 2), dtype=np.int64)  # (first, last) dot index of each pulse
+        self._tree = None
+        self._tree_size = 0  # pulses [0, _tree_size) are in the tree; the remainder are buffered
+
+    def __len__(self):
+        return len(self.features)
+
+    def __contains__(self, name):
+        return name in self._name_ids
+
+    def __repr__(self):
+        return '%s(%d pulses from %d files)' % (self.__class__.__name__, len(self), len(self.names))
+
+    def add(self, name, zc, **kwargs):
+        """Index the pulses of a `ZeroCross` signal. Produces the count of pulses added.
+        A name which is already indexed is skipped. Any `kwargs` are passed to `extract_pulses()`.
+        """
+        if name in self._name_ids:
+            log.warning('Not indexing %s, whose name is already indexed', name)
+            return 0
+        table = extract_pulses(zc, **kwargs)
+        return self._append([name], [zc], table)
+
+    def add_batch(self, names, zcs, **kwargs):
+        """Index the pulses of many `ZeroCross` signals at once. Produces the count of pulses added."""
+        pairs = []
+        for name, zc in zip(names, zcs):
+            if name in self._name_ids:
+                log.warning('Not indexing %s, whose name is already indexed', name)
+            else:
+                pairs.append((name, zc))
+        if not pairs:
+            return 0
+        names, zcs = zip(*pairs)
+        table = extract_pulses_batch(zcs, **kwargs)
+        return self._append(names, zcs, table)
+
+    def _append(self, names, zcs, table):
+        first_id = len(self.names)
+        for i, name in enumerate(names):
+            self._name_ids[name] = first_id + i
+        self.names.extend(names)
+        self.features = np.concatenate((self.features, pulse_features(list(zcs), table)))
+        self.source = np.concatenate((self.source, first_id + table['sequence']))
+        self.dots = np.concatenate((self.dots, np.column_stack((table['first'], table['last']))))
+        if len(self) - self._tree_size > self.rebuild_threshold:
+            self._rebuild()
+        return len(table)
+
+    @print_timing
+    def _rebuild(self):
+        """Merge buffered pulses into a freshly built tree"""
+        self._tree = cKDTree(self.features, leafsize=32) if len(self) else None
+        self._tree_size = len(self)
+
+    def query(self, features, k=10):
+        """Find the `k` indexed pulses nearest a feature vector.
+        Produces a list of (distance, name, first dot, last dot) tuples, nearest first.
+        """
+        features = np.asarray(features, dtype=np.float32)
+        k = min(k, len(self))
+        if not k:
+            return []
+        distances, indexes = np.zeros(0), np.zeros(0, dtype=np.intp)
+        if self._tree is not None:
+            distances, indexes = self._tree.query(features, k=min(k, self._tree_size))
+            distances, indexes = np.atleast_1d(distances), np.atleast_1d(indexes)
+        if len(self) > self._tree_size:
+            buffered = np.sqrt(((self.features[self._tree_size:] - features) ** 2).sum(axis=1))
+            distances = np.concatenate((distances, buffered))
+            indexes = np.concatenate((indexes, np.arange(self._tree_size, len(self))))
+        nearest = np.argsort(distances, kind='mergesort')[:k]
+        return [(float(distances[i]), self.names[self.source[indexes[i]]], int(self.dots[indexes[i], 0]), int(self.dots[indexes[i], 1]))
+                for i in nearest]
+
+    def query_zc(self, zc, pulse=0, k=10, **kwargs):
+        """Find the `k` indexed pulses nearest the `pulse`'th pulse of a reference `ZeroCross`"""
+        table = extract_pulses(zc, **kwargs)
+        if not len(table):
+            raise ValueError('Reference signal has no pulses')
+        return self.query(pulse_features(zc, table[pulse:pulse+1])[0], k)
+
+    @print_timing
+    def save(self, fname):
+        """Persist the index to an .npz file (the tree itself is rebuilt on load)"""
+        with open(fname, 'wb') as outf:
+            np.savez(outf, version=INDEX_VERSION, features=self.features, source=self.source, dots=self.dots,
+                     names=np.array([_text(name).encode('utf-8') for name in self.names], dtype=np.bytes_))
+
+    @classmethod
+    @print_timing
+    def load(cls, fname, **kwargs):
+        """Load an index which was saved with `save()`"""
+        index = cls(**kwargs)
+        with np.load(fname) as npz:
+            if int(npz['version']) > INDEX_VERSION:
+                raise ValueError('Unsupported similarity index version %d: %s' % (npz['version'], fname))
+            index.features, index.source, index.dots = npz['features'], npz['source'], npz['dots']
+            index.names = [name.decode('utf-8') for name in npz['names']]
+        index._name_ids = dict((name, i) for i, name in enumerate(index.names))
+        index._rebuild()
+        return index
+
+
+def _load_zc(path):
+    times, freqs, amplitudes, status, metadata = extract_anabat_dots(path)
+    return ZeroCross(times, freqs, amplitudes, metadata, status)
+
+
+def main(argv=None):
+    from zcant.archive import NightArchive
+    from zcant.validate import find_anabat_files
+
+    parser = argparse.ArgumentParser(prog='python -m zcant.similarity', description='Search for similar pulses')
+    subparsers = parser.add_subparsers(dest='command')
+    add = subparsers.add_parser('add', help='index Anabat files, directories of them, or night archives')
+    add.add_argument('index')
+    add.add_argument('paths', nargs='+', metavar='PATH')
+    query = subparsers.add_parser('query', help='list the pulses most similar to a pulse of an Anabat file')
+    query.add_argument('index')
+    query.add_argument('file')
+    query.add_argument('--pulse', type=int, default=0, help='pulse number within FILE (default: 0)')
+    query.add_argument('-k', type=int, default=10, help='number of matches (default: 10)')
+    args = parser.parse_args(argv)
+
+    if args.command == 'add':
+        index = SimilarityIndex.load(args.index) if os.path.exists(args.index) else SimilarityIndex()
+        root = os.path.dirname(os.path.abspath(args.index))
+        name_of = lambda path: _text(os.path.relpath(os.path.abspath(path), root))  # unique, unlike a basename
+        count = 0
+        for path in args.paths:
+            if path.lower().endswith('.zca'):
+                with NightArchive(path) as archive:
+                    names = [os.path.join(name_of(path), name) for name in archive.names]
+                    count += index.add_batch(names, (archive[i] for i in range(len(archive))))
+                continue
+            for fname in find_anabat_files(path) if os.path.isdir(path) else [path]:
+                try:
+                    count += index.add(name_of(fname), _load_zc(fname))
+                except Exception:
+                    log.exception('Failed indexing %s', fname)
+        index.save(args.index)
+        print('Indexed %d pulses; %r' % (count, index))
+    elif args.command == 'query':
+        index = SimilarityIndex.load(args.index)
+        for distance, name, first, last in index.query_zc(_load_zc(args.file), args.pulse, args.k):
+            print('%.4f\t%s\t%d-%d' % (distance, name, first, last))
+
+
+if __name__ == '__main__':
+    # python -m zcant.similarity
+    main()
@@ -0,0 +1,341 @@
+"""
+A whole night of recordings as one virtual zero-cross signal.
+
+Every file in a directory becomes a "segment" placed on a common time axis, in seconds since the
+first file's timestamp. Only the file headers are read up front; a segment is converted when a
+window first overlaps it, and at most `max_resident` converted segments are kept in memory.
+
+    timeline = NightTimeline.from_dir(dirname)
+    zc = timeline.windowed(0, timeline.duration)  # the whole night, coarsely
+    zc = timeline.windowed(3600.0, 0.05)          # a single pulse, in full detail
+
+Windows which overlap more segments than may be resident are assembled from each segment's coarse
+summary instead (its min and max frequency per `SUMMARY_LEVEL` pyramid bin), which is retained
+after the segment itself is evicted.
+
+An interactive caller shouldn't wait for conversions: `windowed(..., convert=False)` produces only
+what's already converted, listing the segments it lacks as `metadata['pending']`, and a
+`TimelineLoader` converts those in the background.
+
+---------------
+Myotisoft ZCANT
+Copyright (C) 2012-2017 Myotisoft LLC, all rights reserved.
+You may use, distribute, and modify this code under the terms of the MIT License.
+"""
+
+import os
+import os.path
+import wave
+import time
+from fnmatch import fnmatch
+from threading import Thread, Condition, Lock
+from collections import OrderedDict
+
+import numpy as np
+
+from zcant import print_timing
+from zcant.anabat import extract_anabat_header, DotStatus
+from zcant.conversion import extract_timestamp
+from zcant.core import ZeroCross, LoadCancelled, load_zerocross
+from zcant.cache import cache_key
+
+import logging
+log = logging.getLogger(__name__)
+
+
+__all__ = 'NightTimeline', 'TimelineLoader'
+
+
+DEFAULT_SEGMENT_SECS = 15.0  # assumed length of a file whose length we can't tell from its header
+SUMMARY_LEVEL = 10           # pyramid level of segment summaries (bins of about 62 ms)
+
+
+def _is_supported(fname):
+    return (fnmatch(fname, '*.??#') or fnmatch(fname.lower(), '*.zc') or fnmatch(fname.lower(), '*.wav')) \
+        and not fname.startswith('._')
+
+
+def _probe(path):
+    """Cheaply produce (timestamp, duration seconds) of a file from its header; either may be None"""
+    try:
+        if path.lower().endswith('.wav'):
+            wav = wave.open(path, 'rb')
+            try:
+                framerate = wav.getframerate()
+                if framerate <= 48000:
+                    framerate *= 10  # assumed time-expanded, as `load_wav()` does
+                return extract_timestamp(path), wav.getnframes() / float(framerate)
+            finally:
+                wav.close()
+        metadata = extract_anabat_header(path)
+        guano = metadata.get('guano', None)
+        length = guano.get('Length', None) if guano is not None else None
+        return metadata.get('timestamp', None), float(length) if length else None
+    except Exception:
+        log.exception('Failed reading header of %s', path)
+        return None, None
+
+
+class NightTimeline(object):
+    """Virtual `ZeroCross` spanning many files, with lazily converted segments.
+
+    Segment start times come from each file's timestamp; a file without one is placed immediately
+    after its predecessor. Segment end times are estimated from file headers until the segment is
+    actually converted. Segments may be converted from another thread, see `TimelineLoader`.
+    """
+
+    def __init__(self, paths, max_resident=16, cache=None, gate=None, **kwargs):
+        """
+        :param paths: files to include, in order
+        :param max_resident: maximum count of converted segments kept in memory
+        :param cache: optional `ZeroCrossCache` to share conversions with
+        :param gate: optional noise gate applied to each .WAV segment, as for `ZeroCross.gated()`
+        :param kwargs: conversion parameters, as for `load_zerocross()`
+        """
+        self.max_resident = max_resident
+        self.cache = cache
+        self.gate = gate
+        self.kwargs = kwargs
+        self._resident = OrderedDict()  # segment number -> ZeroCross, least recently used first
+        self._summaries = {}            # segment number -> (times, freqs, amplitudes) relative to segment start
+        self._failed = set()            # segment numbers which we couldn't convert
+        self._lock = Lock()
+        self._catalog(list(paths))
+
+    @classmethod
+    def from_dir(cls, dirname, **kwargs):
+        """Timeline of every supported file in a directory"""
+        fnames = sorted((f for f in os.listdir(dirname) if _is_supported(f)), key=lambda s: s.lower())
+        return cls([os.path.join(dirname, fname) for fname in fnames], **kwargs)
+
+    @print_timing
+    def _catalog(self, paths):
+        probed = [_probe(path) for path in paths]
+        timestamps = [ts for ts, _ in probed if ts is not None]
+        self.origin = min(timestamps) if timestamps else None  # datetime of time 0.0
+
+        starts, ends = np.zeros(len(paths)), np.zeros(len(paths))
+        known = np.zeros(len(paths), dtype=bool)
+        end = 0.0
+        for i, (timestamp, duration) in enumerate(probed):
+            starts[i] = (timestamp - self.origin).total_seconds() if timestamp is not None else end
+            known[i] = duration is not None
+            ends[i] = end = starts[i] + (duration if known[i] else DEFAULT_SEGMENT_SECS)
+
+        order = np.argsort(starts, kind='mergesort')
+        self.paths = [paths[i] for i in order]
+        self.starts, self.ends, known = starts[order], ends[order], known[order]
+        # a guessed length shouldn't run into the following segment
+        guessed = ~known[:-1]
+        self.ends[:-1][guessed] = np.maximum(np.minimum(self.ends[:-1][guessed], self.starts[1:][guessed]), self.starts[:-1][guessed])
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __repr__(self):
+        return '%s(%d segments, %.1f sec, %d resident)' % (self.__class__.__name__, len(self), self.duration, len(self._resident))
+
+    @property
+    def duration(self):
+        return float(self.ends.max()) if len(self) else 0.0
+
+    def overlapping(self, start, end):
+        """Produce the numbers of the segments which overlap the time range [start, end]"""
+        return np.flatnonzero((self.starts <= end) & (self.ends >= start))
+
+    def segment(self, i, checkpoint=None, load=load_zerocross):
+        """Produce the converted `ZeroCross` of segment `i`, converting it if it isn't resident.
+        A conversion is done by `load`, called as `load_zerocross()` is.
+        """
+        zc = self._resident_segment(i)
+        if zc is not None:
+            return zc
+        try:
+            zc = self._load(i, checkpoint, load)
+        except LoadCancelled:
+            raise
+        except Exception:
+            self._failed.add(i)
+            raise
+        with self._lock:
+            self._resident.pop(i, None)  # perhaps converted by another thread meanwhile
+            while len(self._resident) >= self.max_resident:
+                evicted, _ = self._resident.popitem(last=False)
+                log.debug('Evicting timeline segment %d', evicted)
+            self._resident[i] = zc
+        return zc
+
+    def _resident_segment(self, i):
+        """Produce segment `i` if it's resident (marking it most recently used), else None"""
+        with self._lock:
+            zc = self._resident.pop(i, None)
+            if zc is not None:
+                self._resident[i] = zc
+            return zc
+
+    def _load(self, i, checkpoint=None, load=load_zerocross):
+        path = self.paths[i]
+        key = cache_key(path, **self.kwargs) if self.cache is not None else None
+        zc = self.cache.get(key) if key else None
+        if zc is None:
+            zc = load(path, checkpoint=checkpoint, **self.kwargs)
+            if key:
+                self.cache.put(key, zc)
+        zc = zc.without_status(DotStatus.OFF)
+        if self.gate and path.lower().endswith('.wav'):
+            zc = zc.gated(self.gate)  # as when viewing a single file, only .WAV files are gated
+        summary = self._summarize(zc) if i not in self._summaries else None
+        with self._lock:
+            if len(zc):
+                self.ends[i] = self.starts[i] + zc.times[-1]  # now we know exactly
+            if summary is not None:
+                self._summaries[i] = summary
+        return zc
+
+    @staticmethod
+    def _summarize(zc):
+        """Decimate a segment to two dots (min and max frequency) per summary bin"""
+        pyramid = zc.get_pyramid()
+        width = pyramid.bin_width(SUMMARY_LEVEL)
+        bins = pyramid.level(SUMMARY_LEVEL)
+        times = np.repeat((bins['bin'] + 0.5) * width, 2)
+        freqs = np.column_stack((bins['fmin'], bins['fmax'])).ravel()
+        amplitudes = np.repeat(bins['amplitude'], 2) if zc.supports_amplitude else None
+        return times, freqs, amplitudes
+
+    def _summary(self, i, convert=True):
+        """Produce the summary of segment `i`; if we don't have it yet, convert it or produce None"""
+        with self._lock:
+            summary = self._summaries.get(i, None)
+        if summary is None and convert:
+            self.segment(i)
+            summary = self._summaries[i]
+        return summary
+
+    @print_timing
+    def windowed(self, start, duration, convert=True):
+        """Produce a `ZeroCross` of all dots within the time window [start, start + duration].
+
+        Dot times are in seconds since the timeline's `origin`. If the window overlaps more than
+        `max_resident` segments, each contributes only its coarse summary.
+
+        Unless `convert`, nothing is converted: a segment which isn't available in the detail
+        wanted contributes its summary if we have one, or else nothing, and the numbers of these
+        segments are listed as `metadata['pending']` of the result.
+        """
+        end = start + duration
+        segments = self.overlapping(start, end)
+        detailed = len(segments) <= self.max_resident
+        parts, pending = [], []
+        for i in segments.tolist():
+            zc = None
+            if detailed:
+                zc = self.segment(i) if convert else self._resident_segment(i)
+            if zc is not None:
+                times, freqs, amplitudes = zc.times, zc.freqs, zc.amplitudes
+                status = zc.status
+            else:
+                summary = self._summary(i, convert)
+                if (summary is None or detailed) and i not in self._failed:
+                    pending.append(i)
+                if summary is None:
+                    continue
+                times, freqs, amplitudes = summary
+                status = None
+            a, b = np.searchsorted(times, [start - self.starts[i], end - self.starts[i]], side='left')
+            parts.append((times[a:b] + self.starts[i], freqs[a:b],
+                          amplitudes[a:b] if amplitudes is not None else None,
+                          status[a:b] if status is not None else None))
+
+        metadata = dict(timestamp=self.origin, filename='', path=os.path.dirname(self.paths[0]) if self.paths else '',
+                        segments=[self.paths[i] for i in segments], pending=pending)
+        if not parts:
+            zc = ZeroCross(np.zeros(0), np.zeros(0), None, metadata)
+        else:
+            times, freqs, amplitudes, status = zip(*parts)
+            zc = ZeroCross(np.concatenate(times), np.concatenate(freqs),
+                           np.concatenate(amplitudes) if all(a is not None for a in amplitudes) else None,
+                           metadata,
+                           np.concatenate(status) if all(s is not None for s in status) else None)
+            if np.any(np.diff(zc.times) < 0):
+                zc = zc[np.argsort(zc.times, kind='mergesort')]  # some recordings overlap in time
+        zc.window = (start, end)
+        return zc
+
+
+class TimelineLoader(Thread):
+    """Single background thread which converts the segments of a `NightTimeline`.
+
+    `request()` replaces the segments wanted (typically a window's `metadata['pending']`), most
+    wanted first. A conversion waits while the `foreground` `Loader` is busy, and one which is no
+    longer wanted is cancelled at its next checkpoint. Each converted segment is reported to
+    `on_segment()`. Conversion is done by `load()`, which subclasses may override.
+    """
+
+    PAUSE_SECS = 0.05  # how often a paused conversion checks whether the foreground is still busy
+
+    def __init__(self, segment_cb, foreground=None):
+        Thread.__init__(self)
+        self.segment_cb = segment_cb
+        self.foreground = foreground
+        self.generation = 0
+        self._timeline = None
+        self._segments = []
+        self._converting = None  # segment number of the conversion in progress
+        self._cond = Condition()
+
+        self.setDaemon(True)
+        self.start()  # start immediately
+
+    def request(self, timeline, segments):
+        """Convert the specified segments of a timeline (and only those)"""
+        with self._cond:
+            if timeline is not self._timeline or (self._converting is not None and self._converting not in segments):
+                self.generation += 1
+            self._timeline = timeline
+            self._segments = [i for i in segments if i != self._converting]
+            self._cond.notify()
+
+    def cancel(self):
+        """Abandon every pending and running conversion"""
+        self.request(None, [])
+
+    def load(self, generation, path, kwargs, checkpoint):
+        """Produce the `ZeroCross` for a segment, may be overridden by subclasses"""
+        return load_zerocross(path, checkpoint=checkpoint, **kwargs)
+
+    def on_segment(self, timeline, i):
+        """Called once segment `i` of a current request is converted, may be overridden by subclasses"""
+        self.segment_cb(timeline, i)
+
+    def run(self):
+        """Thread main"""
+        while True:
+            with self._cond:
+                while not self._segments:
+                    self._cond.wait()
+                i = self._segments.pop(0)
+                timeline, generation = self._timeline, self.generation
+                self._converting = i
+
+            def checkpoint():
+                # yield to the foreground, and give up once superseded
+                while self.foreground is not None and self.foreground.is_busy() and generation == self.generation:
+                    time.sleep(self.PAUSE_SECS)
+                if generation != self.generation:
+                    raise LoadCancelled()
+
+            try:
+                checkpoint()
+                timeline.segment(i, checkpoint, lambda path, checkpoint=None, **kwargs: self.load(generation, path, kwargs, checkpoint))
+            except LoadCancelled:
+                log.debug('Cancelled converting timeline segment %s', timeline.paths[i])
+                continue
+            except Exception:
+                log.exception('Failed converting timeline segment %s', timeline.paths[i])
+                continue
+            finally:
+                with self._cond:
+                    self._converting = None
+            if generation == self.generation:
+                self.on_segment(timeline, i)
@@ -0,0 +1,153 @@
+"""
+Validation (and optional repair) of Anabat sequence files, in bulk.
+
+Usage:
+    python -m zcant.validate [--jobs N] [--report FILE] [--repair OUTDIR] DIR [DIR ...]
+
+Each Anabat file found beneath the specified directories is checked in a pool of worker
+processes, and a report is written with one JSON object per line, eg:
+    {"path": "...", "ok": false, "errors": ["Truncated data at offset 0x3F2 (after 742 dots)"], ...}
+
+With `--repair`, a copy of each damaged file, truncated after its last valid dot, is written to
+the same relative path beneath OUTDIR.
+
+---------------
+Myotisoft ZCANT
+Copyright (C) 2012-2017 Myotisoft LLC, all rights reserved.
+You may use, distribute, and modify this code under the terms of the MIT License.
+"""
+
+from __future__ import print_function
+
+import os
+import os.path
+import sys
+import json
+import mmap
+import struct
+import argparse
+import contextlib
+import multiprocessing
+from fnmatch import fnmatch
+
+import numpy as np
+
+from zcant.anabat import _parse_header, _decode_intervals, AnabatFormatError, ANABAT_HEADER_SIZE
+
+import logging
+log = logging.getLogger(__name__)
+
+
+__all__ = 'validate_file', 'find_anabat_files'
+
+
+def find_anabat_files(root):
+    """Generator which produces the path of every Anabat file beneath a directory"""
+    for dirpath, dirnames, filenames in os.walk(root):
+        for fname in sorted(filenames):
+            if (fnmatch(fname, '*.??#') or fnmatch(fname.lower(), '*.zc')) and not fname.startswith('._'):
+                yield os.path.join(dirpath, fname)
+
+
+def validate_file(path, repair_path=None):
+    """Check the header pointers, RES1, interval encoding and time monotonicity of an Anabat file.
+
+    Produces a report dict. If the data is damaged and `repair_path` is specified, a copy of the
+    file truncated after its last valid dot is written there.
+    """
+    report = dict(path=path, ok=False, errors=[], warnings=[], file_type=None, dots=0, repaired=None)
+    try:
+        size = os.path.getsize(path)
+        report['size'] = size
+        if size < 0x120:
+            report['errors'].append('File too small for an Anabat header (%d bytes)' % size)
+            return report
+        with open(path, 'rb') as f, contextlib.closing(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)) as m:
+            data_info_pointer = struct.unpack_from('< H', m)[0]
+            if data_info_pointer != 0x11a:
+                report['errors'].append('Bad data information table pointer 0x%X' % data_info_pointer)
+                return report
+            file_type, data_pointer, res1, metadata = _parse_header(m)
+            report['file_type'] = file_type
+            min_data_pointer = ANABAT_HEADER_SIZE if file_type >= 132 else 0x120
+            if file_type not in (129, 130, 131, 132):
+                report['warnings'].append('Unknown file type %d' % file_type)
+            if not min_data_pointer <= data_pointer <= size:
+                report['errors'].append('Bad data pointer 0x%X' % data_pointer)
+                return report
+            if res1 != 25000:
+                report['errors'].append('Non-standard RES1 (%d)' % res1)
+
+            zero_intervals = 0
+            try:
+                for intervals_us, status in _decode_intervals(m, data_pointer, 2**14):
+                    report['dots'] += len(intervals_us)
+                    zero_intervals += np.count_nonzero(intervals_us == 0)
+            except AnabatFormatError as e:
+                report['dots'] = e.dots
+                report['errors'].append(str(e))
+                if repair_path:
+                    _write_truncated(m, e.offset, repair_path)
+                    report['repaired'] = repair_path
+            if zero_intervals:
+                report['warnings'].append('%d zero-length intervals (non-increasing times)' % zero_intervals)
+            if not report['dots']:
+                report['warnings'].append('No dots')
+    except Exception as e:
+        log.exception('Failed validating %s', path)
+        report['errors'].append('%s: %s' % (e.__class__.__name__, e))
+    report['ok'] = not report['errors']
+    return report
+
+
+def _write_truncated(m, size, path):
+    """Write the first `size` bytes of buffer `m` to a new file"""
+    outdir = os.path.dirname(path)
+    if outdir and not os.path.exists(outdir):
+        os.makedirs(outdir)
+    with open(path, 'wb') as outf:
+        outf.write(m[:size])
+
+
+def _validate_job(args):
+    """Pool worker entrypoint; `Pool.imap_unordered()` gives us only a single argument"""
+    return validate_file(*args)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m zcant.validate', description='Validate Anabat sequence files')
+    parser.add_argument('dirs', nargs='+', metavar='DIR', help='directory to scan recursively')
+    parser.add_argument('-j', '--jobs', type=int, default=multiprocessing.cpu_count(), help='worker processes (default: CPU count)')
+    parser.add_argument('-r', '--report', metavar='FILE', help='write the JSON-lines report here (default: stdout)')
+    parser.add_argument('--repair', metavar='OUTDIR', help='write truncated copies of damaged files beneath OUTDIR')
+    parser.add_argument('--errors-only', action='store_true', help='report only files which have errors')
+    args = parser.parse_args(argv)
+
+    jobs = []
+    for root in args.dirs:
+        for path in find_anabat_files(root):
+            repair_path = os.path.join(args.repair, os.path.relpath(path, root)) if args.repair else None
+            jobs.append((path, repair_path))
+
+    out = open(args.report, 'w') if args.report else sys.stdout
+    total, bad = 0, 0
+    pool = multiprocessing.Pool(max(args.jobs, 1))
+    try:
+        for report in pool.imap_unordered(_validate_job, jobs, chunksize=64):
+            total += 1
+            bad += not report['ok']
+            if report['ok'] and args.errors_only:
+                continue
+            out.write(json.dumps(report, sort_keys=True) + '\n')
+    finally:
+        pool.close()
+        pool.join()
+        if out is not sys.stdout:
+            out.close()
+    print('Validated %d files, %d with errors' % (total, bad), file=sys.stderr)
+    return 1 if bad else 0
+
+
+if __name__ == '__main__':
+    # python -m zcant.validate
+    sys.exit(main())
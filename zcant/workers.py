@@ -0,0 +1,229 @@
+"""
+Out-of-process conversion, so that the GUI process never does conversion work itself.
+
+Conversion runs in a pool of worker processes which are started (and have imported NumPy, SciPy,
+and our conversion code) before the GUI is. A worker doesn't pickle its result arrays back to us;
+it writes each to an .npy file in a temporary directory, on a RAM-backed filesystem where one is
+available, and we memory-map them (or read them, if small). Only the small metadata dict travels
+through the pool itself.
+
+Cancellation works as for `zcant.core.Loader`: the current request generation is held in shared
+memory, and a worker abandons its conversion at the next checkpoint once it's superseded. Progress
+(each converted chunk, which is small) is sent back through a shared queue.
+
+Background conversions (see `zcant.core.Prefetcher`) run in a separate pool, at a lower OS
+scheduling priority, so they never delay a conversion which the user is waiting for.
+
+---------------
+Myotisoft ZCANT
+Copyright (C) 2012-2017 Myotisoft LLC, all rights reserved.
+You may use, distribute, and modify this code under the terms of the MIT License.
+"""
+
+import os
+import os.path
+import uuid
+try:
+    import Queue as queue
+except ImportError:
+    import queue  # Python 3
+import shutil
+import tempfile
+import multiprocessing
+
+import numpy as np
+
+from zcant.core import ZeroCross, Loader, Prefetcher, LoadCancelled, load_zerocross
+from zcant.cache import load_array
+from zcant.timeline import TimelineLoader
+
+import logging
+log = logging.getLogger(__name__)
+
+
+__all__ = 'ConversionPool', 'ProcessLoader', 'ProcessPrefetcher', 'ProcessTimelineLoader'
+
+
+ARRAYS = 'times', 'freqs', 'amplitudes', 'status'
+
+_generation = None  # worker process's handle to the shared current generation
+_progress = None    # worker process's handle to the shared progress queue
+_warmed = None      # modules a worker process imports up front, so its first conversion needn't
+
+PROGRESS_POLL_SECS = 0.05
+BACKGROUND_NICENESS = 10  # added to the scheduling niceness of background workers
+
+
+def _shared_tempdir():
+    """Prefer a RAM-backed filesystem for transferring arrays, where we have one"""
+    return '/dev/shm' if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK) else None
+
+
+def _warm_worker(generation, progress, niceness=0):
+    """Pool initializer: import everything a conversion needs before our first job arrives"""
+    global _generation, _progress, _warmed
+    _generation, _progress = generation, progress
+    if niceness and hasattr(os, 'nice'):
+        os.nice(niceness)
+    import scipy.signal
+    import zcant.conversion
+    import zcant.anabat
+    _warmed = scipy.signal, zcant.conversion, zcant.anabat
+    log.debug('Conversion worker %d ready', os.getpid())
+
+
+def _convert(generation, path, kwargs, outdir, job=None):
+    """Worker entrypoint: convert a file, writing its arrays beneath `outdir`.
+    Produces ({array name: .npy path}, metadata), or None if cancelled.
+    If `job` is specified, each converted chunk is sent to the progress queue tagged with it.
+    """
+    def checkpoint():
+        if generation is not None and _generation.value != generation:
+            raise LoadCancelled()
+
+    def progress(zc, fraction):
+        _progress.put((job, zc.times, zc.freqs, zc.amplitudes, zc.metadata, fraction))
+
+    try:
+        zc = load_zerocross(path, checkpoint=checkpoint, progress=progress if job else None, **kwargs)
+    except LoadCancelled:
+        return None
+    token = uuid.uuid4().hex
+    fnames = {}
+    for name in ARRAYS:
+        array = getattr(zc, name)
+        if array is None:
+            continue
+        fnames[name] = os.path.join(outdir, '%s.%s.npy' % (token, name))
+        np.save(fnames[name], np.ascontiguousarray(array))
+    return fnames, zc.metadata
+
+
+def _attach(fnames, metadata):
+    """Memory-map (or if small, read) a worker's result arrays as a `ZeroCross`, removing their files"""
+    arrays = {}
+    for name, fname in fnames.items():
+        arrays[name] = load_array(fname)
+        try:
+            os.remove(fname)  # any mapping keeps the data alive
+        except OSError:
+            # can't remove a mapped file on Windows, so copy it and leave the file for `close()`
+            arrays[name] = np.array(arrays[name])
+    return ZeroCross(arrays['times'], arrays['freqs'], arrays.get('amplitudes', None), metadata, arrays.get('status', None))
+
+
+class ConversionPool(object):
+    """Pool of warmed conversion worker processes. Create it before the GUI starts.
+
+    The shared `generation` cancels foreground conversions, and `background_generation` cancels
+    background conversions.
+    """
+
+    def __init__(self, processes=1, background=1):
+        """
+        :param processes: count of foreground worker processes
+        :param background: count of low-priority background worker processes
+        """
+        self.generation = multiprocessing.Value('l', 0)
+        self.background_generation = multiprocessing.Value('l', 0)
+        self.progress = multiprocessing.Queue()
+        self.tempdir = tempfile.mkdtemp(prefix='zcant-', dir=_shared_tempdir())
+        self._pool = multiprocessing.Pool(processes, initializer=_warm_worker, initargs=(self.generation, self.progress))
+        self._background = multiprocessing.Pool(background, initializer=_warm_worker,
+                                                initargs=(self.background_generation, self.progress, BACKGROUND_NICENESS)) if background else None
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__, self.tempdir)
+
+    def convert(self, path, generation=None, progress=None, background=False, **kwargs):
+        """Convert a file in a worker process, producing a `ZeroCross` (or None if cancelled).
+        If `generation` is specified, the conversion is cancelled once the shared generation (or
+        with `background`, the shared background generation) moves on.
+        If `progress` is specified, it's called with a partial `ZeroCross` and the fraction complete
+        as each chunk is converted. Only one conversion at a time should request progress.
+        """
+        job = uuid.uuid4().hex if progress else None
+        pool = self._background if background and self._background is not None else self._pool
+        pending = pool.apply_async(_convert, (generation, path, kwargs, self.tempdir, job))
+        while job and not pending.ready():
+            try:
+                msg = self.progress.get(timeout=PROGRESS_POLL_SECS)
+            except queue.Empty:
+                continue
+            if msg[0] == job:  # else left over from an earlier, abandoned conversion
+                times, freqs, amplitudes, metadata, fraction = msg[1:]
+                progress(ZeroCross(times, freqs, amplitudes, metadata), fraction)
+        result = pending.get()
+        return _attach(*result) if result is not None else None
+
+    def close(self):
+        for pool in (self._pool, self._background):
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+        shutil.rmtree(self.tempdir, ignore_errors=True)
+
+
+class ProcessLoader(Loader):
+    """`Loader` which converts in a `ConversionPool` rather than in our own process"""
+
+    def __init__(self, parent_cb, pool, cache=None, preview=False, progress_cb=None):
+        self.pool = pool
+        Loader.__init__(self, parent_cb, cache, preview, progress_cb)
+
+    def request(self, path, **kwargs):
+        with self._cond:  # publish the new generation before our thread can pick up the request
+            generation = Loader.request(self, path, **kwargs)
+            self.pool.generation.value = generation
+            return generation
+
+    def cancel(self):
+        with self._cond:
+            Loader.cancel(self)
+            self.pool.generation.value = self.generation
+
+    def load(self, generation, path, kwargs, checkpoint, progress=None):
+        result = self.pool.convert(path, generation, progress, **kwargs)
+        if result is None:
+            raise LoadCancelled()
+        return result
+
+
+class ProcessPrefetcher(Prefetcher):
+    """`Prefetcher` which converts in a `ConversionPool`'s background workers"""
+
+    def __init__(self, pool, cache, foreground=None, max_bytes=64*1024*1024):
+        self.pool = pool
+        Prefetcher.__init__(self, cache, foreground, max_bytes)
+
+    def prefetch(self, paths, **kwargs):
+        with self._cond:
+            Prefetcher.prefetch(self, paths, **kwargs)
+            self.pool.background_generation.value = self.generation
+
+    def cancel(self):
+        with self._cond:
+            Prefetcher.cancel(self)
+            self.pool.background_generation.value = self.generation
+
+    def load(self, generation, path, kwargs, checkpoint):
+        result = self.pool.convert(path, generation, background=True, **kwargs)
+        if result is None:
+            raise LoadCancelled()
+        return result
+
+
+class ProcessTimelineLoader(TimelineLoader):
+    """`TimelineLoader` which converts in a `ConversionPool`'s background workers.
+
+    The shared background generation belongs to the `ProcessPrefetcher`, so a segment conversion
+    which is already running in a worker isn't cancelled; superseded segments are only dropped
+    between conversions.
+    """
+
+    def __init__(self, segment_cb, pool, foreground=None):
+        self.pool = pool
+        TimelineLoader.__init__(self, segment_cb, foreground)
+
+    def load(self, generation, path, kwargs, checkpoint):
+        return self.pool.convert(path, background=True, **kwargs)
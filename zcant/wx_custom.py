@@ -26,7 +26,11 @@ class ThresholdToolbarSlider(wx.Slider):
         self._delta = delta
         self._tool = parent_toolbar.AddControl(self, 'Sensitivity %.2f RMS' % threshold)
         self._update_label(self._threshold)
-        self.Bind(wx.EVT_SCROLL_THUMBTRACK, lambda e: self._update_label(e.GetEventObject().GetValue() * self._delta))
+        self.Bind(wx.EVT_SCROLL_THUMBTRACK, self._on_thumbtrack)
+
+    def _on_thumbtrack(self, event):
+        self._update_label(event.GetEventObject().GetValue() * self._delta)
+        event.Skip()  # let our parent frame update live, too
 
     def _update_label(self, threshold):
         self._tool.SetLabel('Sensitivity %.2f RMS' % threshold)